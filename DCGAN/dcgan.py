@@ -1,156 +1,115 @@
+import time
+startup_start = time.perf_counter()
 import torch
-from torch import nn
 import torchvision
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 from yaml import load, Loader
 import os
 import sys
 import datetime
 import shutil
-import pandas as pd
-import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.image_cache import ImageCacheDataset, load_image_cache, batch_sampler
+from utils.loader import TimedLoader, dataloader_options, with_options
+from utils.transforms import BatchTransform
+from utils.in_memory import InMemoryLoader, load_in_memory
+from utils.shards import ShardDataset, load_shards
+from utils.fast_decode import DraftLoader
+from utils.fused import split_batches
+from utils.latent import LatentSampler
+from utils.amp import MixedPrecision
+from utils.execution import prepare_model
+from utils.metrics import MetricAccumulator, write_summary
+from utils.activation_checkpoint import checkpoint_segments
+from utils.threads import set_threads, tune_threads, record_config
+from utils.checkpoint import CheckpointWriter, atomic_dir, atomic_save, snapshot
+from utils.render import Renderer, to_uint8
+from utils.startup import StartupTimer, lazy_import, is_headless, set_headless
+from models import Discriminator, Generator
+
+# Plotting modules are only imported when first used
+plt = lazy_import('matplotlib.pyplot')
+# Figures drawn without pyplot, in the checkpoint writer thread
+mpl_figure = lazy_import('matplotlib.figure')
+pd = lazy_import('pandas')
+timer = StartupTimer(startup_start)
 
 image_size = (1, 64, 64)
 grayscale = True
 DATA_FOLDER = '../data/'
 
 
-class Discriminator(nn.Module):
-    def __init__(self, input_channels, nf):
-        super(Discriminator, self).__init__()
-        self.flattened_size = 64 * \
-            (image_size[1]//2//2//2) * (image_size[2]//2//2//2)
-        self.conv_block = nn.Sequential(
-            # input is (3, 32, 32)
-            nn.Conv2d(input_channels, nf, 4, padding=1, stride=2),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            # input is (nf, 16, 16)
-            nn.Conv2d(nf, nf * 2, 4, padding=1, stride=2),
-            nn.BatchNorm2d(nf * 2),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            # input is (nf*2, 8, 8)
-            nn.Conv2d(nf * 2, nf * 4, 4, padding=1, stride=2),
-            nn.BatchNorm2d(nf * 4),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.Conv2d(nf * 4, nf * 8, 4, padding=1, stride=2),
-            nn.BatchNorm2d(nf * 8),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            # input is (nf*4, 4, 4)
-            nn.Conv2d(nf * 8, 1, 4, padding=0, stride=1),
-            nn.Sigmoid()
-        )
-
-    def forward(self, x):
-        x = self.conv_block(x)
-        return x.view(-1, 1)
-
-    def weight_init(self, mean, std):
-        for m in self._modules:
-            normal_init(self._modules[m], mean, std)
-
-
-class Generator(nn.Module):
-    def __init__(self, input_size, output_channels, nf=128):
-        super(Generator, self).__init__()
-
-        self.conv_block = nn.Sequential(
-            nn.ConvTranspose2d(input_size, nf*8, 4, stride=1, padding=0),
-            nn.BatchNorm2d(nf*8),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.ConvTranspose2d(nf*8, nf*4, 4, stride=2, padding=1),
-            nn.BatchNorm2d(nf*4),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.ConvTranspose2d(nf*4, nf*2, 4, stride=2, padding=1),
-            nn.BatchNorm2d(nf*2),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.ConvTranspose2d(nf*2, nf, 4, stride=2, padding=1),
-            nn.BatchNorm2d(nf),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.ConvTranspose2d(nf, output_channels, 4, stride=2, padding=1),
-            nn.Tanh(),
-        )
-
-    def forward(self, x):
-        x = x.view(x.shape[0], x.shape[1], 1, 1)
-        x = self.conv_block(x)
-        return x
-
-    def weight_init(self, mean, std):
-        for m in self._modules:
-            normal_init(self._modules[m], mean, std)
-
-
-def normal_init(m, mean, std):
-    if isinstance(m, nn.ConvTranspose2d) or isinstance(m, nn.Conv2d):
-        m.weight.data.normal_(mean, std)
-        m.bias.data.zero_()
-
-
 def generator_loss(output_generator):
     return - torch.mean(torch.log(output_generator.squeeze()))
 
 
-def plot_results(result_dir):
-    fig = plt.figure()
-    plt.title('Discriminator Loss')
+def plot_results(result_dir, disc_losses, gen_losses):
+    fig = mpl_figure.Figure()
+    ax = fig.add_subplot()
+    ax.set_title('Discriminator Loss')
     rolling = pd.Series(disc_losses).rolling(rolling_window).mean()
-    plt.plot(range(len(rolling)), rolling)
-    plt.xlabel('Training steps')
-    plt.ylabel('Loss')
-    plt.savefig('{}discriminator_loss'.format(result_dir), dpi=200)
-    plt.close(fig)
-    fig = plt.figure()
-    plt.title('Generator Loss')
+    ax.plot(range(len(rolling)), rolling)
+    ax.set_xlabel('Training steps')
+    ax.set_ylabel('Loss')
+    fig.savefig('{}discriminator_loss'.format(result_dir), dpi=200)
+    fig = mpl_figure.Figure()
+    ax = fig.add_subplot()
+    ax.set_title('Generator Loss')
     rolling = pd.Series(gen_losses).rolling(rolling_window).mean()
-    plt.plot(range(len(rolling)), rolling)
-    plt.xlabel('Training steps')
-    plt.ylabel('Loss')
-    plt.savefig('{}generator_loss'.format(result_dir), dpi=200)
-    plt.close(fig)
+    ax.plot(range(len(rolling)), rolling)
+    ax.set_xlabel('Training steps')
+    ax.set_ylabel('Loss')
+    fig.savefig('{}generator_loss'.format(result_dir), dpi=200)
 
 
 def checkpoint(disc, gen, epoch):
     check_dir = '{}checkpoint_ep{}/'.format(result_dir, epoch)
-    if not os.path.isdir(check_dir):
-        os.makedirs(check_dir)
-    disc_dict = discriminator.state_dict()
-    torch.save(disc_dict, '{}discriminator.pt'.format(check_dir))
-    gen_dict = generator.state_dict()
-    torch.save(gen_dict, '{}generator.pt'.format(check_dir))
-    plot_results(check_dir)
-
-    noises = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-        dtype=torch.FloatTensor).to(device)
+    # Only the snapshots are taken here, checkpoint_writer writes the files
+    noises = latent.sample()
     gen_output = generator(noises).detach()
-    fig = plt.figure()
-    for idx in np.arange(16):
-        ax = fig.add_subplot(4, 4, idx+1, xticks=[], yticks=[])
-        imshow(gen_output[idx].cpu().numpy())
-    plt.savefig('{}generated'.format(check_dir), dpi=200)
-    plt.close(fig)
+    gen_output = to_uint8(gen_output).cpu() if frame_renderer == 'png' else gen_output.cpu()
+    losses = (list(disc_losses), list(gen_losses))
+    checkpoint_writer.submit(write_checkpoint, check_dir, snapshot(discriminator),
+                             snapshot(generator), losses, gen_output)
+
+
+def write_checkpoint(check_dir, disc_dict, gen_dict, losses, gen_output):
+    with atomic_dir(check_dir) as tmp_dir:
+        torch.save(disc_dict, '{}discriminator.pt'.format(tmp_dir))
+        torch.save(gen_dict, '{}generator.pt'.format(tmp_dir))
+        plot_results(tmp_dir, *losses)
+
+        if frame_renderer != 'png':
+            fig = mpl_figure.Figure()
+            for idx in np.arange(16):
+                ax = fig.add_subplot(4, 4, idx+1, xticks=[], yticks=[])
+                imshow(gen_output[idx].numpy(), ax)
+            fig.savefig('{}generated'.format(tmp_dir), dpi=200)
+    if frame_renderer == 'png':
+        # Rendered by the worker, once the checkpoint directory is complete
+        renderer.submit(gen_output[:16], '{}generated'.format(check_dir))
 
 
 def generate_frame(disc, gen, epoch):
-    noises = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-        dtype=torch.FloatTensor).to(device)
+    noises = latent.sample()
     gen_output = generator(noises).detach()
-    fig = plt.figure()
+    if renderer is not None:
+        renderer.render_async(gen_output[:16], '{}frame_{}'.format(video_dir, epoch),
+                              'Epoch {}'.format(epoch + 1))
+    if frame_renderer == 'matplotlib' and frame_png:
+        checkpoint_writer.submit(write_frame, '{}frame_{}'.format(video_dir, epoch),
+                                 gen_output.cpu(), epoch)
+
+
+def write_frame(path, gen_output, epoch):
+    fig = mpl_figure.Figure()
     for idx in np.arange(16):
         ax = fig.add_subplot(4, 4, idx+1, xticks=[], yticks=[])
-        imshow(gen_output[idx].cpu().numpy())
+        imshow(gen_output[idx].numpy(), ax)
     fig.suptitle('Epoch {}'.format(epoch + 1))
-    plt.savefig('{}frame_{}'.format(video_dir, epoch), dpi=200)
-    plt.close(fig)
+    fig.savefig(path, dpi=200)
 
 
 '''def get_train_loader(batch_size):
@@ -172,15 +131,29 @@ def generate_frame(disc, gen, epoch):
     return iter(train_loader), train_loader'''
 
 
-def load_dataset(batch_size, dataset, image_size):
+def load_dataset(batch_size, dataset, image_size, data_format='folder',
+                 loader_options=None, fast_decode=False):
     if dataset not in ['MNIST', 'CIFAR10', 'CELEBA']:
         print('Dataset not known: {}'.format(dataset))
         sys.exit(-1)
+    if data_format not in ['folder', 'cache', 'shards', 'memory']:
+        print('Data format not known: {}'.format(data_format))
+        sys.exit(-1)
+    if data_format == 'memory' and dataset not in ['MNIST', 'CIFAR10']:
+        print('Data format memory is only available for MNIST and CIFAR10')
+        sys.exit(-1)
+    if loader_options is None:
+        loader_options = {}
+    # Batches are kept as uint8, normalization is done by BatchTransform
     transform = torchvision.transforms.Compose([
         torchvision.transforms.Resize((image_size, image_size)),
-        torchvision.transforms.ToTensor(),
-        torchvision.transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        torchvision.transforms.PILToTensor()
     ])
+    if fast_decode:
+        # Decode JPEGs close to image_size instead of at full resolution
+        image_loader = DraftLoader(image_size)
+    else:
+        image_loader = torchvision.datasets.folder.default_loader
     if dataset == 'MNIST':
         train_data = torchvision.datasets.MNIST(
             DATA_FOLDER, train=True,
@@ -201,23 +174,58 @@ def load_dataset(batch_size, dataset, image_size):
         )
     elif dataset == 'CELEBA':
         data_path = 'data/img_align_celeba/'
-        train_data = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transform
+        if data_format == 'cache':
+            train_data = load_image_cache(data_path, image_size)
+        elif data_format == 'shards':
+            train_data = load_shards(data_path, image_size, fast_decode,
+                                     num_workers=loader_options.get('num_workers', 0))
+        else:
+            train_data = torchvision.datasets.ImageFolder(
+                root=data_path,
+                transform=transform,
+                loader=image_loader
+            )
+
+    if data_format == 'memory':
+        # Resize the whole dataset once and keep it on the training device
+        drop_last = loader_options.get('drop_last', False)
+        train_loader = InMemoryLoader(
+            *load_in_memory(train_data, image_size), batch_size,
+            drop_last=drop_last, device=device)
+        test_loader = InMemoryLoader(
+            *load_in_memory(test_data, image_size), batch_size,
+            drop_last=drop_last, device=device)
+        return iter(train_loader), train_loader, test_loader
+    if isinstance(train_data, ImageCacheDataset):
+        # The cache returns whole batches, so batching is done by the sampler
+        options = dict(loader_options)
+        drop_last = options.pop('drop_last', False)
+        train_loader = torch.utils.data.DataLoader(
+            train_data,
+            batch_size=None,
+            sampler=batch_sampler(train_data, batch_size, drop_last),
+            **options
+        )
+    elif isinstance(train_data, ShardDataset):
+        # Shuffling is done by the dataset with the shard order and a buffer
+        train_loader = torch.utils.data.DataLoader(
+            train_data,
+            batch_size=batch_size,
+            **loader_options
+        )
+    else:
+        train_loader = torch.utils.data.DataLoader(
+            train_data,
+            batch_size=batch_size,
+            shuffle=True,
+            **loader_options
         )
-
-    train_loader = torch.utils.data.DataLoader(
-        train_data,
-        batch_size=batch_size,
-        num_workers=0,
-        shuffle=True
-    )
     if dataset != 'CELEBA':
         test_loader = torch.utils.data.DataLoader(
             test_data,
             batch_size=batch_size,
-            num_workers=0,
-            shuffle=True
+            shuffle=True,
+            **loader_options
         )
     else:
         test_loader = train_loader
@@ -232,18 +240,24 @@ def load_dataset(batch_size, dataset, image_size):
     return batch[0].to(device), batch[1].to(device), iterator, train_loader'''
 
 
-def imshow(img):
+def imshow(img, ax=None):
+    # Draws on ax, the current pyplot axes by default
+    ax = plt if ax is None else ax
     img = img / 2 + 0.5  # unnormalize
     if grayscale:
-        plt.imshow(np.squeeze(img), cmap='gray')
+        ax.imshow(np.squeeze(img), cmap='gray')
     else:
-        plt.imshow(np.transpose(img, (1, 2, 0)))
+        ax.imshow(np.transpose(img, (1, 2, 0)))
 
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', type=str, default='config.yml')
+args = parser.parse_args()
+
 # Load hyperparameters
-stream = open('config.yml', 'r')
+stream = open(args.config, 'r')
 config = load(stream, Loader)
 
 dataset = config['dataset']
@@ -259,14 +273,54 @@ discriminator_filters = config['discriminator_filters']
 generator_filters = config['generator_filters']
 discriminator_label_noise = config['discriminator_label_noise']
 discriminator_input_noise = config['discriminator_input_noise']
-
-# Create the result directory
-result_dir = '{}_e{}_d{}_g{}/'.format(
-    datetime.datetime.now().strftime('%y-%m-%d_%H-%M'),
-    epochs,
-    discriminator_filters,
-    generator_filters
-)
+data_format = config.get('data_format', 'folder')
+fast_decode = config.get('fast_decode', False)
+fused_critic = config.get('fused_critic', False)
+precision = config.get('precision', 'fp32')
+if precision not in ['fp32', 'bf16', 'fp16']:
+    print('Precision not known: {}'.format(precision))
+    sys.exit(-1)
+channels_last = config.get('channels_last', False)
+compile_models = config.get('compile', False)
+# Gradients of each step accumulated over micro_batches sub-batches
+micro_batches = config.get('micro_batches', 1)
+# Segments of the conv blocks recomputed during backward, 'all' or indices
+discriminator_checkpoint_segments = config.get('discriminator_checkpoint_segments', [])
+generator_checkpoint_segments = config.get('generator_checkpoint_segments', [])
+# With frame_renderer: png, sample grids are written as PNGs by a worker
+# process instead of matplotlib figures. With frame_gif the frames are also
+# appended to an animated GIF as the epochs finish, and frame_png: False
+# leaves out the PNG of each frame. The worker is forked here, before
+# CUDA is initialized and any thread starts
+frame_renderer = config.get('frame_renderer', 'matplotlib')
+if frame_renderer not in ['matplotlib', 'png']:
+    print('Frame renderer not known: {}'.format(frame_renderer))
+    sys.exit(-1)
+frame_png = config.get('frame_png', True)
+renderer = None
+if frame_renderer == 'png' or config.get('frame_gif', False):
+    renderer = Renderer(nrow=4, scale=config.get('frame_scale', 1),
+                        png=frame_renderer == 'png' and frame_png)
+# Latent noise sampled on the device, latent_block_steps batches at a time
+latent = LatentSampler(n_noise_features, batch_size, device,
+                       config.get('latent_block_steps', 1), config.get('latent_seed', 'auto'))
+headless = is_headless(config.get('headless', 'auto'))
+if headless:
+    set_headless()
+set_threads(config.get('threads_per_process', 'auto'), config.get('interop_threads', 'auto'))
+timer.mark('imports and config')
+
+# Create the result directory, named after the date and the filters
+# unless set in the config
+result_dir = config.get('result_dir', 'auto')
+if result_dir == 'auto':
+    result_dir = '{}_e{}_d{}_g{}/'.format(
+        datetime.datetime.now().strftime('%y-%m-%d_%H-%M'),
+        epochs,
+        discriminator_filters,
+        generator_filters
+    )
+result_dir = os.path.join(result_dir, '')
 if not os.path.isdir(result_dir):
     os.makedirs(result_dir)
 else:
@@ -274,20 +328,41 @@ else:
     sys.exit(-1)
 
 # Copy the config.yml to result directory
-shutil.copy2('config.yml', '{}config.yml'.format(result_dir))
+shutil.copy2(args.config, '{}config.yml'.format(result_dir))
 
 # Create the directory for the frames of the epochs
 video_dir = '{}video/'.format(result_dir)
 if not os.path.isdir(video_dir):
     os.makedirs(video_dir)
 
-discriminator = Discriminator(image_size[0], discriminator_filters).to(device)
+if renderer is not None and config.get('frame_gif', False):
+    renderer.start_gif('{}{}.gif'.format(video_dir, dataset.lower()))
+# Checkpoints and frames written in the background with async_checkpoints,
+# all the plotting during training happens in its thread
+checkpoint_writer = CheckpointWriter(config.get('async_checkpoints', False))
+
+discriminator = Discriminator(
+    image_size[0], discriminator_filters, image_size=image_size).to(device)
 generator = Generator(
-    n_noise_features, image_size[0], generator_filters).to(device)
+    n_noise_features, image_size[0], generator_filters, image_size=image_size).to(device)
 discriminator.weight_init(mean=0.0, std=0.02)
 generator.weight_init(mean=0.0, std=0.02)
 
+# Activation checkpointing of the selected conv segments
+checkpoint_segments(discriminator, discriminator_checkpoint_segments)
+checkpoint_segments(generator, generator_checkpoint_segments)
+
+# Forward passes under autocast with bf16/fp16, loss scaling with fp16
+amp = MixedPrecision(precision, device)
+amp.wrap(discriminator)
+amp.wrap(generator)
+disc_scaler, gen_scaler = amp.scaler(), amp.scaler()
+# Opt-in channels_last memory format and torch.compile
+prepare_model(discriminator, channels_last, compile_models)
+prepare_model(generator, channels_last, compile_models)
+
 print('Discriminator\n{}\n\nGenerator\n{}'.format(discriminator, generator))
+timer.mark('models')
 
 disc_optimizer = torch.optim.Adam(
     discriminator.parameters(), lr=0.0002, betas=(0.5, 0.999))
@@ -298,46 +373,72 @@ loss = torch.nn.BCELoss()
 # iterator, train_loader = get_train_loader(batch_size)
 iterator, train_loader, test_loader = load_dataset(batch_size,
                                                    dataset,
-                                                   image_size[1])
-images = iterator.next()[0].numpy()
-print('Image size: {}'.format(images[0].shape))
-# Plot images
-fig = plt.figure()
-for idx in np.arange(16):
-    ax = fig.add_subplot(4, 4, idx+1, xticks=[], yticks=[])
-    imshow(images[idx])
-plt.show()
-plt.close(fig)
-
-# Plot images with noise
-input_noise = np.random.randn(*images[0].shape) * 0.07
-fig = plt.figure()
-for idx in np.arange(10):
-    ax = fig.add_subplot(5, 2, idx+1, xticks=[], yticks=[])
-    if idx % 2 == 0:
+                                                   image_size[1],
+                                                   data_format,
+                                                   dataloader_options(config, device),
+                                                   fast_decode)
+# Split of the cores between compute threads and loader workers, measured on
+# a few steps of the models and written to the config.yml of the results
+if config.get('tune_threads', False):
+    threads, num_workers = tune_threads(
+        discriminator, generator, n_noise_features, batch_size, image_size, device,
+        train_loader, k, gen_steps, channels_last)
+    if isinstance(train_loader, torch.utils.data.DataLoader):
+        train_loader = with_options(
+            train_loader, dataloader_options(dict(config, num_workers=num_workers), device))
+        iterator = iter(train_loader)
+    record_config('{}config.yml'.format(result_dir), {
+        'threads_per_process': threads, 'num_workers': num_workers, 'tune_threads': False})
+    timer.mark('thread tuning')
+train_loader = TimedLoader(train_loader)
+batch_transform = BatchTransform(channels_last=channels_last)
+timer.mark('dataset')
+# Preview a batch, skipped in headless mode
+if not headless:
+    images = batch_transform(next(iterator)[0]).numpy()
+    print('Image size: {}'.format(images[0].shape))
+    # Plot images
+    fig = plt.figure()
+    for idx in np.arange(16):
+        ax = fig.add_subplot(4, 4, idx+1, xticks=[], yticks=[])
         imshow(images[idx])
-    else:
-        imshow(images[idx-1] + input_noise)
-plt.show()
-plt.close(fig)
+    plt.show()
+    plt.close(fig)
+
+    # Plot images with noise
+    input_noise = np.random.randn(*images[0].shape) * 0.07
+    fig = plt.figure()
+    for idx in np.arange(10):
+        ax = fig.add_subplot(5, 2, idx+1, xticks=[], yticks=[])
+        if idx % 2 == 0:
+            imshow(images[idx])
+        else:
+            imshow(images[idx-1] + input_noise)
+    plt.show()
+    plt.close(fig)
+    timer.mark('preview')
+timer.report()
 
 disc_losses, gen_losses = [], []
+# Losses are kept on the device and flushed every flush_metrics_every steps
+metrics = MetricAccumulator(None, config.get('flush_metrics_every', 100))
+train_start = time.time()
 
 for e in range(epochs):
     if e % print_every == 0:
         print('Epoch {}'.format(e))
     start = time.time()
     epoch_dlosses, epoch_glosses = [], []
+    train_loader.reset()
     for images, _ in train_loader:
-        images = images.to(device)
+        images = batch_transform(images.to(device, non_blocking=True))
         noise_factor = (epochs - e) / epochs
         #########################
         # Train the discriminator
         #########################
         for i in range(k):
-            disc_optimizer.zero_grad()
-            noises = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-                dtype=torch.FloatTensor).to(device)
+            disc_optimizer.zero_grad(set_to_none=True)
+            noises = latent.sample()
             # Apply noise to input images
             if discriminator_input_noise:
                 input_noise_d = torch.randn(
@@ -347,8 +448,10 @@ for e in range(epochs):
                 images = images + input_noise_d
                 noises = noises + input_noise_g
             # Compute output of both the discriminator and generator
-            disc_output = discriminator(images)
-            gen_output = discriminator(generator(noises))
+            # The critic step does not update the generator, so its fakes are
+            # produced without building an autograd graph
+            with torch.no_grad():
+                gen_images = generator(noises)
             # Apply noise to labels
             disc_label_noise = torch.ones(images.shape[0], 1).to(device)
             gen_label_noise = torch.zeros(batch_size, 1).to(device)
@@ -357,49 +460,76 @@ for e in range(epochs):
                     images.shape[0], 1) * 0.2 * noise_factor).to(device)
                 gen_label_noise += (torch.rand(batch_size, 1)
                                     * 0.2 * noise_factor).to(device)
-            # Compute the discriminator loss
-            disc_loss = loss(disc_output, disc_label_noise)
-            gen_loss = loss(gen_output, gen_label_noise)
-            disc_loss = disc_loss + gen_loss
-            # Perform the optimization step for the discriminator
-            disc_loss.backward()
-            disc_optimizer.step()
+            # The last batch of an epoch can be smaller than micro_batches.
+            # tensor_split always gives n_micro pieces, so the real and fake
+            # batches of different sizes are split alike and none is dropped
+            n_micro = min(micro_batches, images.shape[0])
+            disc_loss = 0
+            for real, fake, real_labels, fake_labels in zip(
+                    images.tensor_split(n_micro), gen_images.tensor_split(n_micro),
+                    disc_label_noise.tensor_split(n_micro), gen_label_noise.tensor_split(n_micro)):
+                if fused_critic:
+                    # One forward pass over real and fake images, BatchNorm still
+                    # normalizes each of them with its own statistics
+                    split_sizes = [real.shape[0], fake.shape[0]]
+                    with split_batches(discriminator, split_sizes):
+                        output = discriminator(torch.cat([real, fake]))
+                    disc_output, gen_output = output.split(split_sizes)
+                else:
+                    disc_output = discriminator(real)
+                    gen_output = discriminator(fake)
+                # Compute the discriminator loss, each micro-batch adds its
+                # share of the batch loss to the gradients
+                mb_loss = loss(disc_output, real_labels) * (real.shape[0] / images.shape[0]) + \
+                    loss(gen_output, fake_labels) * (fake.shape[0] / batch_size)
+                # Perform the optimization step for the discriminator
+                disc_scaler.scale(mb_loss).backward()
+                disc_loss = disc_loss + mb_loss.detach()
+            disc_scaler.step(disc_optimizer)
+            disc_scaler.update()
             # Save the loss
-            disc_losses.append(disc_loss.item())
-            epoch_dlosses.append(disc_loss.item())
+            metrics.add(disc_loss, [disc_losses, epoch_dlosses])
+            metrics.step()
 
         #######################
         # Train the generator
         #######################
         for i in range(gen_steps):
-            gen_optimizer.zero_grad()
-            noises = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-                dtype=torch.FloatTensor).to(device)
-            gen_images = generator(noises)
-            gen_output = discriminator(gen_images)
-            # Compute the generator loss
-            gen_loss = loss(gen_output, torch.ones(batch_size, 1).to(device))
-            # Perform the optimization step for the generator
-            gen_loss.backward()
-            gen_optimizer.step()
+            gen_optimizer.zero_grad(set_to_none=True)
+            gen_loss = 0
+            for noises in latent.sample().chunk(micro_batches):
+                gen_images = generator(noises)
+                gen_output = discriminator(gen_images)
+                # Compute the generator loss
+                mb_loss = loss(gen_output, torch.ones(noises.shape[0], 1).to(device)) * \
+                    (noises.shape[0] / batch_size)
+                # Perform the optimization step for the generator
+                gen_scaler.scale(mb_loss).backward()
+                gen_loss = gen_loss + mb_loss.detach()
+            gen_scaler.step(gen_optimizer)
+            gen_scaler.update()
             # Save the loss
-            gen_losses.append(gen_loss.item())
-            epoch_glosses.append(gen_loss.item())
+            metrics.add(gen_loss, [gen_losses, epoch_glosses])
         #print('------------', gen_loss.item(), np.mean(temp3))
         #print([x.grad for x in list(generator.parameters())])
+    metrics.flush()
     generate_frame(discriminator, generator, e)
     if e % print_every == 0:
-        print('D loss: {:.5f}\tG loss: {:.5f}\tTime: {:.0f}'.format(
-            np.mean(epoch_dlosses), np.mean(epoch_glosses), time.time() - start))
+        print('D loss: {:.5f}\tG loss: {:.5f}\tTime: {:.0f}\tData wait: {:.1f}'.format(
+            np.mean(epoch_dlosses), np.mean(epoch_glosses), time.time() - start,
+            train_loader.wait_time))
     if e != 0 and e % checkpoints == 0:
         checkpoint(discriminator, generator, e)
 
 
+checkpoint_writer.close()
+if renderer is not None:
+    renderer.close()
+train_time = time.time() - train_start
 disc_accs, gen_accs = [], []
 for test, _ in train_loader:
-    test = test.to(device)
-    noises = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-        dtype=torch.FloatTensor).to(device)
+    test = batch_transform(test.to(device, non_blocking=True))
+    noises = latent.sample()
     disc_output = discriminator(test).detach().to('cpu')
     gen_output = generator(noises).detach()
     #print(disc_output.shape, gen_output.to('cpu').shape)
@@ -409,6 +539,13 @@ for test, _ in train_loader:
 
 print('Discriminator accuracy on real data: {}\nDiscriminator accuracy on generated data: {}'.format(
     np.mean(disc_accs), 1 - np.mean(gen_accs)))
+write_summary(result_dir, {
+    'd_loss': np.mean(epoch_dlosses),
+    'g_loss': np.mean(epoch_glosses),
+    'real_accuracy': np.mean(disc_accs),
+    'generated_accuracy': 1 - np.mean(gen_accs),
+    'train_time': train_time
+})
 
 
 # Plot 16 generated images
@@ -427,11 +564,11 @@ for i in range(min(batch_size, 5)):
     plt.close(fig)
 
 # Plot the generator and discriminator losses
-plot_results(result_dir)
+plot_results(result_dir, disc_losses, gen_losses)
 
 # Save the models
 disc_dict = discriminator.state_dict()
-torch.save(disc_dict, '{}discriminator.pt'.format(result_dir))
+atomic_save(disc_dict, '{}discriminator.pt'.format(result_dir))
 
 gen_dict = generator.state_dict()
-torch.save(gen_dict, '{}generator.pt'.format(result_dir))
+atomic_save(gen_dict, '{}generator.pt'.format(result_dir))
@@ -0,0 +1,270 @@
+import math
+
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from utils.latent import LatentSampler
+from utils.startup import lazy_import
+
+# Plotting modules are only imported when first used
+plt = lazy_import('matplotlib.pyplot')
+pd = lazy_import('pandas')
+
+# Mean and std of the real distribution, as in generate_data of gan.py
+REAL_MEAN, REAL_STD = 3., 1.
+
+
+class EnsembleLinear(nn.Module):
+    # n_members independent nn.Linear layers, applied with one batched matmul
+    # to inputs of shape (n_members, batch, in_features)
+    def __init__(self, n_members, in_features, out_features):
+        super(EnsembleLinear, self).__init__()
+        # Same initialization as nn.Linear, drawn independently for each member
+        bound = 1 / math.sqrt(in_features)
+        self.weight = nn.Parameter(
+            torch.empty(n_members, in_features, out_features).uniform_(-bound, bound))
+        self.bias = nn.Parameter(torch.empty(n_members, 1, out_features).uniform_(-bound, bound))
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleDiscriminator(nn.Module):
+    # n_members Discriminators of gan.py stacked along the first dimension
+    def __init__(self, n_members, input_size, layer_sizes, output_size, dropout_prob=0.5):
+        super(EnsembleDiscriminator, self).__init__()
+        sizes = [input_size] + list(layer_sizes)
+        self.layers = nn.ModuleList(
+            [EnsembleLinear(n_members, a, b) for a, b in zip(sizes[:-1], sizes[1:])])
+        self.dropout = torch.nn.Dropout(p=dropout_prob)
+        self.output = EnsembleLinear(n_members, layer_sizes[-1], output_size)
+        self.sigmoid = nn.Sigmoid()
+        self.leaky_relu = nn.LeakyReLU(negative_slope=0.2)
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = self.dropout(self.leaky_relu(layer(x)))
+        return self.sigmoid(self.output(x))
+
+
+class EnsembleGenerator(nn.Module):
+    # n_members Generators of gan.py stacked along the first dimension
+    def __init__(self, n_members, input_size, layer_sizes, output_size, dropout_prob=0.5):
+        super(EnsembleGenerator, self).__init__()
+        sizes = [input_size] + list(layer_sizes)
+        self.layers = nn.ModuleList(
+            [EnsembleLinear(n_members, a, b) for a, b in zip(sizes[:-1], sizes[1:])])
+        self.dropout = torch.nn.Dropout(p=dropout_prob)
+        self.leaky_relu = nn.LeakyReLU(negative_slope=0.2)
+        self.output = EnsembleLinear(n_members, layer_sizes[-1], output_size)
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = self.dropout(self.leaky_relu(layer(x)))
+        return self.leaky_relu(self.output(x))
+
+
+class MemberAdam(object):
+    # Adam with one learning rate per member. The step is taken with lr=1 and
+    # the update of each member is then scaled by its learning rate, which is
+    # exact since the Adam update is proportional to lr.
+    def __init__(self, params, lr, betas):
+        self.params = list(params)
+        self.lr = lr
+        self.optimizer = torch.optim.Adam(self.params, lr=1., betas=betas)
+
+    def zero_grad(self):
+        self.optimizer.zero_grad(set_to_none=True)
+
+    @torch.no_grad()
+    def step(self):
+        old = [p.clone() for p in self.params]
+        self.optimizer.step()
+        for p, o in zip(self.params, old):
+            p.sub_(o).mul_(self.lr.view(-1, *[1] * (p.dim() - 1))).add_(o)
+
+
+def member_values(value, n_members, name):
+    # A scalar for all the members, or a list with one value per member
+    if not isinstance(value, (list, tuple)):
+        value = [value] * n_members
+    if len(value) != n_members:
+        raise ValueError('{} has {} values for {} members'.format(name, len(value), n_members))
+    return value
+
+
+def bce(output, target):
+    # Binary cross entropy of each member, shape (n_members,)
+    return F.binary_cross_entropy(output, target.expand_as(output), reduction='none').mean(dim=(1, 2))
+
+
+def train_ensemble(config, device):
+    # Trains ensemble_size independent GANs of gan.py at once. The losses of
+    # the members are summed, so each member gets the gradients of its own
+    # loss, and all the per-step metrics stay on the device until the end.
+    n_members = config['ensemble_size']
+    n_features = config['n_features']
+    n_noise_features = config['n_noise_features']
+    batch_size = config['batch_size']
+    k, gen_steps = config['k'], config['gen_steps']
+    print_every = config['print_every']
+    disc_lr = torch.tensor(member_values(
+        config.get('ensemble_disc_lr', 0.0002), n_members, 'ensemble_disc_lr'), device=device)
+    gen_lr = torch.tensor(member_values(
+        config.get('ensemble_gen_lr', 0.0002), n_members, 'ensemble_gen_lr'), device=device)
+    latent = LatentSampler(n_noise_features, n_members * batch_size, device,
+                           config.get('latent_block_steps', 1), config.get('latent_seed', 'auto'),
+                           distribution='uniform')
+
+    def real_data(n_samples):
+        data = torch.randn(n_members, n_samples, n_features, device=device).sort(dim=2)[0]
+        return data * REAL_STD + REAL_MEAN
+
+    def noise(n_samples=batch_size):
+        samples = latent.sample(n_members * n_samples)
+        return samples.view(n_members, n_samples, n_noise_features).sort(dim=2)[0]
+
+    discriminator = EnsembleDiscriminator(
+        n_members, n_features, config['discriminator_layers'], 1).to(device)
+    generator = EnsembleGenerator(
+        n_members, n_noise_features, config['generator_layers'], n_features).to(device)
+    print('Ensemble of {} members\nDiscriminator\n{}\n\nGenerator\n{}'.format(
+        n_members, discriminator, generator))
+    disc_optimizer = MemberAdam(discriminator.parameters(), disc_lr, betas=(0.5, 0.999))
+    gen_optimizer = MemberAdam(generator.parameters(), gen_lr, betas=(0.5, 0.999))
+    ones = torch.ones(1, 1, 1, device=device)
+    zeros = torch.zeros(1, 1, 1, device=device)
+
+    disc_losses, gen_losses, gen_means, gen_stds = [], [], [], []
+    for e in range(config['epochs']):
+        for i in range(k):
+            disc_optimizer.zero_grad()
+            with torch.no_grad():
+                generated = generator(noise())
+            disc_loss = (bce(discriminator(real_data(batch_size)), ones) +
+                         bce(discriminator(generated), zeros)) / 2
+            disc_loss.sum().backward()
+            disc_optimizer.step()
+            disc_losses.append(disc_loss.detach())
+
+        for i in range(gen_steps):
+            gen_optimizer.zero_grad()
+            generated = generator(noise())
+            gen_loss = bce(discriminator(generated), ones)
+            gen_loss.sum().backward()
+            gen_optimizer.step()
+            gen_losses.append(gen_loss.detach())
+            generated = generated.detach().flatten(1)
+            gen_means.append(generated.mean(dim=1))
+            gen_stds.append(generated.std(dim=1))
+        if e % print_every == 0:
+            print('Epoch {}\tD loss: {:.5f}\tG loss: {:.5f}\tMean: {:.3f}\tStd: {:.3f}'.format(
+                e, disc_losses[-1].mean().item(), gen_losses[-1].mean().item(),
+                gen_means[-1].mean().item(), gen_stds[-1].mean().item()))
+
+    # Same test as gan.py, for every member
+    with torch.no_grad():
+        test = real_data(2000)
+        gen_output = generator(noise(2000))
+        disc_accuracy = discriminator(test).mean(dim=(1, 2))
+        gen_accuracy = 1 - discriminator(gen_output).mean(dim=(1, 2))
+
+    history = {
+        'disc_loss': torch.stack(disc_losses).cpu().numpy(),
+        'gen_loss': torch.stack(gen_losses).cpu().numpy(),
+        'gen_mean': torch.stack(gen_means).cpu().numpy(),
+        'gen_std': torch.stack(gen_stds).cpu().numpy(),
+    }
+    members = pd.DataFrame({
+        'disc_lr': disc_lr.cpu().numpy(),
+        'gen_lr': gen_lr.cpu().numpy(),
+        'disc_accuracy': disc_accuracy.cpu().numpy(),
+        'gen_accuracy': gen_accuracy.cpu().numpy(),
+    })
+    return discriminator, generator, history, members, test.cpu(), gen_output.cpu()
+
+
+def converged_step(values, target, window, tolerance):
+    # First generator step after which the rolling mean of values stays
+    # within tolerance of target, NaN for the members that never converge
+    rolling = pd.DataFrame(values).rolling(window, min_periods=1).mean().values
+    outside = np.abs(rolling - target) > tolerance
+    steps = np.full(values.shape[1], np.nan)
+    for m in range(values.shape[1]):
+        bad = np.nonzero(outside[:, m])[0]
+        if len(bad) == 0:
+            steps[m] = 0
+        elif bad[-1] < len(values) - 1:
+            steps[m] = bad[-1] + 1
+    return steps
+
+
+def report(history, members, window, tolerance=0.1):
+    # Final value of each member (mean of the last window steps), how fast it
+    # converged, and the mean and std of all of them
+    for name in ['disc_loss', 'gen_loss', 'gen_mean', 'gen_std']:
+        members[name] = history[name][-window:].mean(axis=0)
+    members['mean_converged_step'] = converged_step(history['gen_mean'], REAL_MEAN, window, tolerance)
+    members['std_converged_step'] = converged_step(history['gen_std'], REAL_STD, window, tolerance)
+    print(members.to_string())
+    summary = pd.DataFrame({'mean': members.mean(), 'std': members.std()})
+    print('\nAcross {} members (real mean {}, real std {})\n{}'.format(
+        len(members), REAL_MEAN, REAL_STD, summary.to_string()))
+    return summary
+
+
+def plot_band(values, title, ylabel, path, window, target=None):
+    # Mean over the members of the rolling mean, with a band of one std
+    rolling = pd.DataFrame(values).rolling(window, min_periods=1).mean()
+    mean, std = rolling.mean(axis=1), rolling.std(axis=1).fillna(0)
+    fig = plt.figure()
+    plt.title(title)
+    plt.plot(range(len(mean)), mean)
+    plt.fill_between(range(len(mean)), mean - std, mean + std, alpha=0.3)
+    if target is not None:
+        plt.axhline(target, color='gray', linestyle='--')
+    plt.xlabel('Training steps')
+    plt.ylabel(ylabel)
+    plt.savefig(path, dpi=200)
+    plt.close(fig)
+
+
+def plot_ensemble(result_dir, history, test, gen_output, window):
+    plot_band(history['disc_loss'], 'Discriminator Loss', 'Loss',
+              '{}discriminator_loss'.format(result_dir), window)
+    plot_band(history['gen_loss'], 'Generator Loss', 'Loss',
+              '{}generator_loss'.format(result_dir), window)
+    plot_band(history['gen_mean'], 'Mean', 'Mean', '{}mean'.format(result_dir), window, REAL_MEAN)
+    plot_band(history['gen_std'], 'Standard Deviation', 'Std',
+              '{}std'.format(result_dir), window, REAL_STD)
+
+    fig = plt.figure()
+    plt.title('Generated vs Real Distributions')
+    plt.hist(test[0, :, 0].numpy(), bins=50, density=True, histtype='step',
+             color='black', label='Real - dim 0')
+    for m in range(gen_output.shape[0]):
+        plt.hist(gen_output[m, :, 0].numpy(), bins=50, density=True, histtype='step', alpha=0.4)
+    plt.xlabel('Samples')
+    plt.legend()
+    plt.savefig('{}generated_vs_real_distribution'.format(result_dir), dpi=200)
+    plt.close(fig)
+
+
+def run_ensemble(config, result_dir, device):
+    discriminator, generator, history, members, test, gen_output = train_ensemble(config, device)
+    window = config['print_every']
+    report(history, members, window).to_csv('{}ensemble_summary.csv'.format(result_dir))
+    members.to_csv('{}ensemble_members.csv'.format(result_dir), index_label='member')
+    plot_ensemble(result_dir, history, test, gen_output, window)
+
+    # Stacked weights, member m is index m of the first dimension
+    disc_dict = discriminator.state_dict()
+    disc_dict['layers'] = config['discriminator_layers']
+    disc_dict['n_features'] = config['n_features']
+    torch.save(disc_dict, '{}ensemble_discriminator.pt'.format(result_dir))
+    gen_dict = generator.state_dict()
+    gen_dict['layers'] = config['generator_layers']
+    gen_dict['n_features'] = config['n_features']
+    torch.save(gen_dict, '{}ensemble_generator.pt'.format(result_dir))
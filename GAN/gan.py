@@ -2,15 +2,22 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 from yaml import load, Loader
 import os
 import sys
 import datetime
 import shutil
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.latent import LatentSampler
+from utils.startup import lazy_import
+from ensemble import run_ensemble
+
+# Plotting modules are only imported when first used
+plt = lazy_import('matplotlib.pyplot')
+sns = lazy_import('seaborn')
+pd = lazy_import('pandas')
+
 
 class Discriminator(nn.Module):
     def __init__(self, input_size, layer_sizes, output_size, dropout_prob=0.5):
@@ -63,7 +70,7 @@ def generate_data(n_samples):
 
 
 def generate_noise(n_samples):
-    return torch.from_numpy(np.sort(np.random.rand(batch_size, n_noise_features))).type(dtype=torch.FloatTensor)
+    return latent.sample(n_samples).sort(dim=1)[0]
 
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -83,6 +90,12 @@ batch_size = config['batch_size']
 print_every = config['print_every']
 discriminator_layers = config['discriminator_layers']
 generator_layers = config['generator_layers']
+# Number of independent GANs trained at once, 1 for a single one
+ensemble_size = config.get('ensemble_size', 1)
+# Latent noise sampled on the device, latent_block_steps batches at a time
+latent = LatentSampler(n_noise_features, batch_size, device,
+                       config.get('latent_block_steps', 1), config.get('latent_seed', 'auto'),
+                       distribution='uniform')
 
 result_dir = '{}/'.format(datetime.datetime.now().strftime('%y-%m-%d_%H-%M'))
 if not os.path.isdir(result_dir):
@@ -91,6 +104,12 @@ else:
     print('The result directory {} already exists, ABORTING')
     sys.exit(-1)
 
+if ensemble_size > 1:
+    # The members are stacked and trained with batched matmuls, see ensemble.py
+    run_ensemble(config, result_dir, device)
+    shutil.copy2('config.yml', '{}config.yml'.format(result_dir))
+    sys.exit(0)
+
 n_samples = n_samples // batch_size * batch_size
 #train = torch.from_numpy(np.random.randn(n_samples, n_features) + 1).type(dtype=torch.FloatTensor)
 train = generate_data(n_samples)
@@ -119,7 +138,7 @@ for e in range(epochs):
     #########################
     for i in range(k):
         disc_optimizer.zero_grad()
-        noises = generate_noise(batch_size).to(device)
+        noises = generate_noise(batch_size)
         '''idx = np.random.randint(n_samples, size=batch_size)
         batch = train[idx, :]'''
         batch = generate_data(batch_size).to(device)
@@ -143,7 +162,7 @@ for e in range(epochs):
     #discriminator.eval()
     for i in range(gen_steps):
         gen_optimizer.zero_grad()
-        noises = generate_noise(batch_size).to(device)
+        noises = generate_noise(batch_size)
         generated = generator(noises)
         gen_output = discriminator(generated)
         #print(torch.mean(gen_output).item())
@@ -164,7 +183,7 @@ for e in range(epochs):
 #discriminator.eval()
 #generator.eval()
 test = generate_data(2000).to(device)
-noises = generate_noise(2000).detach().to(device)
+noises = generate_noise(2000)
 disc_output = discriminator(test).detach().to('cpu')
 gen_output = generator(noises).detach()
 print(disc_output.shape, gen_output.to('cpu').shape)
@@ -1,184 +1,174 @@
+import time
+startup_start = time.perf_counter()
 import torch
-from torch import nn
 import torchvision
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 from yaml import load, Loader
 import os
 import sys
 import datetime
 import shutil
-import pandas as pd
-import time
-from tensorboardX import SummaryWriter
 import argparse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.image_cache import ImageCacheDataset, load_image_cache, batch_sampler
+from utils.loader import dataloader_options, num_batches, with_options
+from utils.transforms import BatchTransform
+from utils.in_memory import InMemoryLoader, load_in_memory
+from utils.shards import ShardDataset, load_shards
+from utils.fast_decode import DraftLoader
+from utils.prefetch import InfiniteBatches
+from utils.latent import LatentSampler
+from utils.amp import MixedPrecision
+from utils.execution import prepare_model, eager
+from utils.params import ParamGroup
+from utils.metrics import MetricAccumulator, write_summary
+from utils.activation_checkpoint import checkpoint_segments
+from utils.distributed import GradientAllReduce, init_distributed, broadcast_object, close_distributed
+from utils.threads import set_threads, tune_threads, record_config
+from utils.checkpoint import CheckpointWriter, atomic_dir, atomic_save, snapshot
+from utils.render import Renderer, to_uint8
+from utils.startup import Lazy, StartupTimer, lazy_import, is_headless, set_headless
+from models import Discriminator, Generator
+
+# Plotting and logging modules are only imported when first used
+plt = lazy_import('matplotlib.pyplot')
+# Figures drawn without pyplot, in the checkpoint writer thread
+mpl_figure = lazy_import('matplotlib.figure')
+pd = lazy_import('pandas')
+tensorboardX = lazy_import('tensorboardX')
+timer = StartupTimer(startup_start)
+
 image_size = (3, 64, 64)
 grayscale = False
 DATA_FOLDER = '../data/'
 
 
-class Discriminator(nn.Module):
-    def __init__(self, input_channels, nf):
-        super(Discriminator, self).__init__()
-        self.flattened_size = 64 * \
-            (image_size[1]//2//2//2) * (image_size[2]//2//2//2)
-        self.conv_block = nn.Sequential(
-            # input is (3, 32, 32)
-            nn.Conv2d(input_channels, nf, 4, padding=1, stride=2, bias=False),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            # input is (nf, 16, 16)
-            nn.Conv2d(nf, nf * 2, 4, padding=1, stride=2, bias=False),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            # input is (nf*2, 8, 8)
-            nn.Conv2d(nf * 2, nf * 4, 4, padding=1, stride=2, bias=False),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.Conv2d(nf * 4, nf * 8, 4, padding=1, stride=2, bias=False),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            # input is (nf*4, 4, 4)
-            nn.Conv2d(nf * 8, 1, 4, padding=0, stride=1, bias=False),
-        )
-
-    def forward(self, x):
-        x = self.conv_block(x)
-        return x.view(-1, 1)
-
-    def weight_init(self, mean, std):
-        for m in self._modules:
-            normal_init(self._modules[m], mean, std)
-
-
-class Generator(nn.Module):
-    def __init__(self, input_size, output_channels, nf=128):
-        super(Generator, self).__init__()
-
-        if image_size[1] == 64:
-            self.first_block = nn.Sequential(
-                nn.ConvTranspose2d(input_size, nf*8, 4, stride=1,
-                                padding=0, bias=False),
-                nn.BatchNorm2d(nf*8),
-                nn.LeakyReLU(negative_slope=0.2, inplace=True)
-            )
-        elif image_size[1] == 128:
-            self.first_block = nn.Sequential(
-                nn.ConvTranspose2d(input_size, nf*16, 4, stride=1,
-                                padding=0, bias=False),
-                nn.BatchNorm2d(nf*16),
-                nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-                nn.ConvTranspose2d(nf*16, nf*8, 4, stride=2, padding=1, bias=False),
-                nn.BatchNorm2d(nf*8),
-                nn.LeakyReLU(negative_slope=0.2, inplace=True),
-            )
-
-        self.conv_block = nn.Sequential(
-            nn.ConvTranspose2d(nf*8, nf*4, 4, stride=2, padding=1, bias=False),
-            nn.BatchNorm2d(nf*4),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.ConvTranspose2d(nf*4, nf*2, 4, stride=2, padding=1, bias=False),
-            nn.BatchNorm2d(nf*2),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.ConvTranspose2d(nf*2, nf, 4, stride=2, padding=1, bias=False),
-            nn.BatchNorm2d(nf),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-
-            nn.ConvTranspose2d(nf, output_channels, 4,
-                               stride=2, padding=1, bias=False),
-            nn.Tanh(),
-        )
-
-    def forward(self, x):
-        x = x.view(x.shape[0], x.shape[1], 1, 1)
-        x = self.first_block(x)
-        x = self.conv_block(x)
-        return x
-
-    def weight_init(self, mean, std):
-        for m in self._modules:
-            normal_init(self._modules[m], mean, std)
-
-
-def normal_init(m, mean, std):
-    if isinstance(m, nn.ConvTranspose2d) or isinstance(m, nn.Conv2d):
-        m.weight.data.normal_(mean, std)
-        m.bias.data.zero_()
-
-
-def compute_gradient_penalty(real, fake, discriminator, lambda_pen):
+def interpolate(real, fake):
     # Compute the sample as a linear combination
     alpha = torch.rand(real.shape[0], 1, 1, 1).to(device)
     alpha = alpha.expand_as(real)
     x_hat = alpha * real + (1 - alpha) * fake
-    # Compute the output
-    x_hat = torch.autograd.Variable(x_hat, requires_grad=True)
-    out = discriminator(x_hat)
+    return torch.autograd.Variable(x_hat, requires_grad=True)
+
+
+def penalty_from_output(out, x_hat, lambda_pen):
+    if disc_scaler.is_enabled():
+        # With fp16 go through the scaled mean of the output, like the loss,
+        # so that the gradients neither underflow nor overflow. The scale
+        # stays on the device, get_scale() would wait for it on every step
+        grad_outputs = None
+        unscale = out.shape[0] / disc_scaler.scale(torch.ones((), device=out.device))
+        out = disc_scaler.scale(torch.mean(out))
+    else:
+        grad_outputs = torch.ones(out.size()).to(device)
+        unscale = 1
     # compute the gradient relative to the new sample
     gradients = torch.autograd.grad(
         outputs=out,
         inputs=x_hat,
-        grad_outputs=torch.ones(out.size()).to(device),
+        grad_outputs=grad_outputs,
         create_graph=True,
         retain_graph=True,
         only_inputs=True)[0]
-    # Reshape the gradients to take the norm
-    gradients = gradients.view(gradients.shape[0], -1)
+    # Reshape the gradients to take the norm, always in fp32
+    gradients = gradients.float().reshape(gradients.shape[0], -1) * unscale
     # Compute the gradient penalty
     penalty = (gradients.norm(2, dim=1) - 1) ** 2
     penalty = penalty * lambda_pen
     return penalty
 
 
+def compute_gradient_penalty(real, fake, discriminator, lambda_pen):
+    x_hat = interpolate(real, fake)
+    # Compute the output
+    with eager(compile_models):
+        out = discriminator(x_hat)
+    return penalty_from_output(out, x_hat, lambda_pen)
+
+
+def critic_loss(real, fake, penalty_step):
+    # Critic loss on a batch or micro-batch, with the Wasserstein distance
+    # estimate and the mean gradient penalty (None if not a penalty step)
+    n_penalty = max(1, int(round(real.shape[0] * gp_batch_fraction))) if penalty_step else 0
+    gradient_penalty = None
+    if fused_critic:
+        disc_output, gen_output, gradient_penalty = fused_critic_forward(
+            real, fake, discriminator, lambda_pen, n_penalty)
+    else:
+        disc_output = discriminator(real)
+        gen_output = discriminator(fake)
+        #disc_output.backward(torch.ones(batch_size, 1).to(device))
+        #gen_output.backward(- torch.ones(batch_size, 1).to(device))
+        if penalty_step:
+            gradient_penalty = compute_gradient_penalty(
+                real[:n_penalty], fake[:n_penalty], discriminator, lambda_pen)
+    loss = torch.mean(gen_output - disc_output)
+    if penalty_step:
+        gradient_penalty = torch.mean(gradient_penalty)
+        loss = loss + gp_every * gradient_penalty
+    return loss, torch.mean(disc_output - gen_output), gradient_penalty
+
+
+def fused_critic_forward(real, fake, discriminator, lambda_pen, n_penalty):
+    # Single forward pass of the critic over real, fake and interpolated
+    # samples. The critic has no BatchNorm, so each output only depends on
+    # its own sample and the result is the same as with three passes.
+    # The penalty uses the first n_penalty samples, none if n_penalty is 0.
+    if n_penalty == 0:
+        disc_output, gen_output = discriminator(torch.cat([real, fake])).split(real.shape[0])
+        return disc_output, gen_output, None
+    x_hat = interpolate(real[:n_penalty], fake[:n_penalty])
+    with eager(compile_models):
+        out = discriminator(torch.cat([real, fake, x_hat]))
+    disc_output, gen_output, out_hat = out.split([real.shape[0], fake.shape[0], n_penalty])
+    return disc_output, gen_output, penalty_from_output(out_hat, x_hat, lambda_pen)
+
+
 def plot_results(result_dir, disc_losses, gen_losses, w_distances, gradient_penalty_list):
     disc_losses = [-x for x in disc_losses]
-    fig = plt.figure()
-    plt.title('Discriminator Negative Loss')
+    fig = mpl_figure.Figure()
+    ax = fig.add_subplot()
+    ax.set_title('Discriminator Negative Loss')
     smoothed = pd.DataFrame(disc_losses).ewm(alpha=0.1, adjust=False)
-    plt.plot(range(len(disc_losses)), disc_losses, alpha=0.7)
-    plt.plot(range(len(disc_losses)), smoothed.mean()[0])
-    plt.xlabel('Training steps')
-    plt.yscale('log')
-    plt.ylabel('Loss')
-    plt.savefig('{}discriminator_loss_smoothed'.format(result_dir), dpi=300)
-    plt.close(fig)
-
-    fig = plt.figure()
-    plt.title('Generator Loss')
+    ax.plot(range(len(disc_losses)), disc_losses, alpha=0.7)
+    ax.plot(range(len(disc_losses)), smoothed.mean()[0])
+    ax.set_xlabel('Training steps')
+    ax.set_yscale('log')
+    ax.set_ylabel('Loss')
+    fig.savefig('{}discriminator_loss_smoothed'.format(result_dir), dpi=300)
+
+    fig = mpl_figure.Figure()
+    ax = fig.add_subplot()
+    ax.set_title('Generator Loss')
     smoothed = pd.DataFrame(gen_losses).ewm(alpha=0.1, adjust=False)
-    plt.plot(range(len(gen_losses)), gen_losses, alpha=0.7)
-    plt.plot(range(len(gen_losses)), smoothed.mean()[0])
-    plt.xlabel('Training steps')
-    plt.ylabel('Loss')
-    plt.savefig('{}generator_loss_smoothed'.format(result_dir), dpi=300)
-    plt.close(fig)
-
-    fig = plt.figure()
-    plt.title('Wasserstein Distance Estimate')
+    ax.plot(range(len(gen_losses)), gen_losses, alpha=0.7)
+    ax.plot(range(len(gen_losses)), smoothed.mean()[0])
+    ax.set_xlabel('Training steps')
+    ax.set_ylabel('Loss')
+    fig.savefig('{}generator_loss_smoothed'.format(result_dir), dpi=300)
+
+    fig = mpl_figure.Figure()
+    ax = fig.add_subplot()
+    ax.set_title('Wasserstein Distance Estimate')
     smoothed = pd.DataFrame(w_distances).ewm(alpha=0.1, adjust=False)
-    plt.plot(range(len(w_distances)), w_distances, alpha=0.7)
-    plt.plot(range(len(w_distances)), smoothed.mean()[0])
-    plt.xlabel('Training steps')
-    plt.yscale('log')
-    plt.ylabel('Distance')
-    plt.savefig('{}wasserstein_distance'.format(result_dir), dpi=300)
-    plt.close(fig)
-
-    fig = plt.figure()
-    plt.title('Gradient Penalty')
+    ax.plot(range(len(w_distances)), w_distances, alpha=0.7)
+    ax.plot(range(len(w_distances)), smoothed.mean()[0])
+    ax.set_xlabel('Training steps')
+    ax.set_yscale('log')
+    ax.set_ylabel('Distance')
+    fig.savefig('{}wasserstein_distance'.format(result_dir), dpi=300)
+
+    fig = mpl_figure.Figure()
+    ax = fig.add_subplot()
+    ax.set_title('Gradient Penalty')
     smoothed = pd.DataFrame(gradient_penalty_list).ewm(alpha=0.1, adjust=False)
-    plt.plot(range(len(gradient_penalty_list)), gradient_penalty_list, alpha=0.7)
-    plt.plot(range(len(gradient_penalty_list)), smoothed.mean()[0])
-    plt.xlabel('Training steps')
-    plt.yscale('log')
-    plt.ylabel('Penalty')
-    plt.savefig('{}gradient_penalty'.format(result_dir), dpi=300)
-    plt.close(fig)
+    ax.plot(range(len(gradient_penalty_list)), gradient_penalty_list, alpha=0.7)
+    ax.plot(range(len(gradient_penalty_list)), smoothed.mean()[0])
+    ax.set_xlabel('Training steps')
+    ax.set_yscale('log')
+    ax.set_ylabel('Penalty')
+    fig.savefig('{}gradient_penalty'.format(result_dir), dpi=300)
 
 
 def checkpoint(disc, gen, epoch):
@@ -186,43 +176,77 @@ def checkpoint(disc, gen, epoch):
         check_dir = '{}checkpoint_ep{}/'.format(result_dir, epoch)
     else:
         check_dir = '{}checkpoint_resumed_ep{}/'.format(result_dir, epoch)
-    if not os.path.isdir(check_dir):
-        os.makedirs(check_dir)
-    disc_dict = discriminator.state_dict()
-    torch.save(disc_dict, '{}discriminator.pt'.format(check_dir))
-    gen_dict = generator.state_dict()
-    torch.save(gen_dict, '{}generator.pt'.format(check_dir))
-    plot_results(check_dir, disc_losses, gen_losses, w_distances, gradient_penalty_list)
-
-    noises = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-        dtype=torch.FloatTensor).to(device)
+    # Only the snapshots are taken here, checkpoint_writer writes the files
+    noises = latent.sample()
     gen_output = generator(noises).detach()
-    fig = plt.figure(figsize=(10, 10))
-    imshow(gen_output.cpu())
-    plt.title('Epoch {}'.format(epoch+1))
-    plt.savefig('{}generated'.format(check_dir), dpi=300)
-    plt.close(fig)
+    gen_output = to_uint8(gen_output).cpu() if frame_renderer == 'png' else gen_output.cpu()
+    losses = (list(disc_losses), list(gen_losses), list(w_distances), list(gradient_penalty_list))
+    checkpoint_writer.submit(write_checkpoint, check_dir, snapshot(discriminator),
+                             snapshot(generator), losses, gen_output, epoch)
+
+
+def write_checkpoint(check_dir, disc_dict, gen_dict, losses, gen_output, epoch):
+    with atomic_dir(check_dir) as tmp_dir:
+        torch.save(disc_dict, '{}discriminator.pt'.format(tmp_dir))
+        torch.save(gen_dict, '{}generator.pt'.format(tmp_dir))
+        plot_results(tmp_dir, *losses)
+
+        if frame_renderer != 'png':
+            fig = mpl_figure.Figure(figsize=(10, 10))
+            ax = fig.add_subplot()
+            imshow(gen_output, ax)
+            ax.set_title('Epoch {}'.format(epoch+1))
+            fig.savefig('{}generated'.format(tmp_dir), dpi=300)
+    if frame_renderer == 'png':
+        # Rendered by the worker, once the checkpoint directory is complete
+        renderer.submit(gen_output, '{}generated'.format(check_dir), 'Epoch {}'.format(epoch+1))
 
 
 def generate_frame(disc, gen, epoch, input_noise):
+    frame_name = '{}frame_reusmed_{}' if resume_training else '{}frame_{}' 
     gen_output = generator(input_noise).detach()
-    fig = plt.figure(figsize=(10, 10))
-    imshow(gen_output.cpu())
+    if renderer is not None:
+        renderer.render_async(gen_output, frame_name.format(video_dir, epoch),
+                              'Epoch {}'.format(epoch + 1))
+    if frame_renderer == 'matplotlib' and frame_png:
+        checkpoint_writer.submit(write_frame, frame_name.format(video_dir, epoch),
+                                 gen_output.cpu(), epoch)
+
+
+def write_frame(path, gen_output, epoch):
+    fig = mpl_figure.Figure(figsize=(10, 10))
+    ax = fig.add_subplot()
+    imshow(gen_output, ax)
     fig.suptitle('Epoch {}'.format(epoch + 1))
-    frame_name = '{}frame_reusmed_{}' if resume_training else '{}frame_{}' 
-    plt.savefig(frame_name.format(video_dir, epoch), dpi=300)
-    plt.close(fig)
+    fig.savefig(path, dpi=300)
 
 
-def load_dataset(batch_size, dataset, image_size):
+def load_dataset(batch_size, dataset, image_size, data_format='folder',
+                 loader_options=None, fast_decode=False, rank=0, world_size=1):
     if dataset not in ['MNIST', 'CIFAR10', 'CELEBA', 'POKEMON', 'CATS']:
         print('Dataset not known: {}'.format(dataset))
+        close_distributed()
         sys.exit(-1)
+    if data_format not in ['folder', 'cache', 'shards', 'memory']:
+        print('Data format not known: {}'.format(data_format))
+        close_distributed()
+        sys.exit(-1)
+    if data_format == 'memory' and dataset not in ['MNIST', 'CIFAR10']:
+        print('Data format memory is only available for MNIST and CIFAR10')
+        close_distributed()
+        sys.exit(-1)
+    if loader_options is None:
+        loader_options = {}
+    # Batches are kept as uint8, normalization is done by BatchTransform
     transform = torchvision.transforms.Compose([
         torchvision.transforms.Resize((image_size, image_size)),
-        torchvision.transforms.ToTensor(),
-        torchvision.transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        torchvision.transforms.PILToTensor()
     ])
+    if fast_decode:
+        # Decode JPEGs close to image_size instead of at full resolution
+        image_loader = DraftLoader(image_size)
+    else:
+        image_loader = torchvision.datasets.folder.default_loader
     if dataset == 'MNIST':
         train_data = torchvision.datasets.MNIST(
             DATA_FOLDER, train=True,
@@ -243,68 +267,125 @@ def load_dataset(batch_size, dataset, image_size):
         )
     elif dataset == 'CELEBA':
         data_path = '{}img_align_celeba/'.format(DATA_FOLDER)
-        train_data = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transform
-        )
+        if data_format == 'cache':
+            train_data = load_image_cache(data_path, image_size)
+        elif data_format == 'shards':
+            train_data = load_shards(data_path, image_size, fast_decode, rank, world_size,
+                                     loader_options.get('num_workers', 0))
+        else:
+            train_data = torchvision.datasets.ImageFolder(
+                root=data_path,
+                transform=transform,
+                loader=image_loader
+            )
     elif dataset == 'CATS':
         data_path = '{}cats/'.format(DATA_FOLDER)
-        train_data = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transform
-        )
+        if data_format == 'cache':
+            train_data = load_image_cache(data_path, image_size)
+        elif data_format == 'shards':
+            train_data = load_shards(data_path, image_size, fast_decode, rank, world_size,
+                                     loader_options.get('num_workers', 0))
+        else:
+            train_data = torchvision.datasets.ImageFolder(
+                root=data_path,
+                transform=transform,
+                loader=image_loader
+            )
     elif dataset == 'POKEMON':
-        transform = torchvision.transforms.Compose([
-            torchvision.transforms.Resize((image_size, image_size)),
-            torchvision.transforms.RandomHorizontalFlip(),
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-        ])
+        # The random flip is done by BatchTransform
         data_path = '{}pokemon/'.format(DATA_FOLDER)
-        train_data = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transform
-        )
+        if data_format == 'cache':
+            train_data = load_image_cache(data_path, image_size)
+        elif data_format == 'shards':
+            train_data = load_shards(data_path, image_size, fast_decode, rank, world_size,
+                                     loader_options.get('num_workers', 0))
+        else:
+            train_data = torchvision.datasets.ImageFolder(
+                root=data_path,
+                transform=transform,
+                loader=image_loader
+            )
 
-    train_loader = torch.utils.data.DataLoader(
-        train_data,
-        batch_size=batch_size,
-        num_workers=0,
-        shuffle=True
-    )
+    if data_format == 'memory':
+        # Resize the whole dataset once and keep it on the training device
+        drop_last = loader_options.get('drop_last', False)
+        train_loader = InMemoryLoader(
+            *load_in_memory(train_data, image_size), batch_size,
+            drop_last=drop_last, device=device, rank=rank, world_size=world_size)
+        test_loader = InMemoryLoader(
+            *load_in_memory(test_data, image_size), batch_size,
+            drop_last=drop_last, device=device)
+        return train_loader, test_loader
+    if isinstance(train_data, ImageCacheDataset):
+        # The cache returns whole batches, so batching is done by the sampler
+        options = dict(loader_options)
+        drop_last = options.pop('drop_last', False)
+        train_loader = torch.utils.data.DataLoader(
+            train_data,
+            batch_size=None,
+            sampler=batch_sampler(train_data, batch_size, drop_last, world_size > 1),
+            **options
+        )
+    elif isinstance(train_data, ShardDataset):
+        # Shuffling is done by the dataset with the shard order and a buffer
+        train_loader = torch.utils.data.DataLoader(
+            train_data,
+            batch_size=batch_size,
+            **loader_options
+        )
+    elif world_size > 1:
+        # Each process loads its own share of every epoch
+        train_loader = torch.utils.data.DataLoader(
+            train_data,
+            batch_size=batch_size,
+            sampler=torch.utils.data.DistributedSampler(train_data),
+            **loader_options
+        )
+    else:
+        train_loader = torch.utils.data.DataLoader(
+            train_data,
+            batch_size=batch_size,
+            shuffle=True,
+            **loader_options
+        )
     if dataset not in ['CELEBA', 'POKEMON', 'CATS']:
         test_loader = torch.utils.data.DataLoader(
             test_data,
             batch_size=batch_size,
-            num_workers=0,
-            shuffle=True
+            shuffle=True,
+            **loader_options
         )
     else:
         test_loader = train_loader
     return train_loader, test_loader
 
 
-def imshow(images):
+def imshow(images, ax=None):
+    # Draws on ax, the current pyplot axes by default
+    ax = plt if ax is None else ax
     images = images / 2 + 0.5  # unnormalize
     grid = torchvision.utils.make_grid(images)
     if grayscale:
-        plt.imshow(grid.squeeze(), cmap='gray')
+        ax.imshow(grid.squeeze(), cmap='gray')
     else:
-        plt.imshow(grid.permute(1, 2, 0))
+        ax.imshow(grid.permute(1, 2, 0))
 
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--resume_from_folder', type=str, default='None')
+parser.add_argument('--config', type=str, default='config.yml')
 args = parser.parse_args()
 
+# Only --resume_from_folder resumes a run, the resume_training key of the
+# config copied to the result directory is not read
 if args.resume_from_folder != 'None':
     args.resume_from_folder += '/' if args.resume_from_folder != '/' else ''
     config_file = args.resume_from_folder + 'config.yml'
     resume_training = True
 else:
-    config_file = 'config.yml'
+    config_file = args.config
     resume_training = False
 
 # Load hyperparameters
@@ -324,39 +405,121 @@ discriminator_filters = config['discriminator_filters']
 generator_filters = config['generator_filters']
 discriminator_label_noise = config['discriminator_label_noise']
 discriminator_input_noise = config['discriminator_input_noise']
-resume_training = config['resume_training']
 lambda_pen = config['lambda_pen']
-
-# Create the result directory
+data_format = config.get('data_format', 'folder')
+fast_decode = config.get('fast_decode', False)
+headless = is_headless(config.get('headless', 'auto'))
+if headless:
+    set_headless()
+timer.mark('imports and config')
+prefetch_batches = config.get('prefetch_batches', 2)
+steps_per_epoch = config.get('steps_per_epoch', 'auto')
+fused_critic = config.get('fused_critic', False)
+# Lazy regularization: gradient penalty every gp_every critic steps, scaled
+# by gp_every, computed on a gp_batch_fraction of the batch
+gp_every = config.get('gp_every', 1)
+gp_batch_fraction = config.get('gp_batch_fraction', 1.)
+precision = config.get('precision', 'fp32')
+if precision not in ['fp32', 'bf16', 'fp16']:
+    print('Precision not known: {}'.format(precision))
+    sys.exit(-1)
+channels_last = config.get('channels_last', False)
+compile_models = config.get('compile', False)
+# Gradients of each step accumulated over micro_batches sub-batches
+micro_batches = config.get('micro_batches', 1)
+# Segments of the conv blocks recomputed during backward, 'all' or indices
+discriminator_checkpoint_segments = config.get('discriminator_checkpoint_segments', [])
+generator_checkpoint_segments = config.get('generator_checkpoint_segments', [])
+# With frame_renderer: png, sample grids are written as PNGs by a worker
+# process instead of matplotlib figures. With frame_gif the frames are also
+# appended to an animated GIF as the epochs finish, and frame_png: False
+# leaves out the PNG of each frame. The worker is forked here, before
+# the process group and CUDA start threads. Frames are written by rank 0
+frame_renderer = config.get('frame_renderer', 'matplotlib')
+if frame_renderer not in ['matplotlib', 'png']:
+    print('Frame renderer not known: {}'.format(frame_renderer))
+    sys.exit(-1)
+frame_png = config.get('frame_png', True)
+renderer = None
+if int(os.environ.get('RANK', 0)) == 0 and (frame_renderer == 'png' or config.get('frame_gif', False)):
+    renderer = Renderer(scale=config.get('frame_scale', 1),
+                        png=frame_renderer == 'png' and frame_png)
+# Data parallel training when launched by torchrun with several processes,
+# each one trains on batch_size / world_size samples per step
+rank, world_size = init_distributed(config.get('distributed_backend', 'gloo'))
+set_threads(config.get('threads_per_process', 'auto'), config.get('interop_threads', 'auto'))
+if batch_size % world_size != 0:
+    print('Batch size {} is not divisible by the {} processes'.format(batch_size, world_size))
+    close_distributed()
+    sys.exit(-1)
+batch_size //= world_size
+# Latent noise sampled on the device, latent_block_steps batches at a time,
+# with a different stream on each process
+latent_seed = config.get('latent_seed', 'auto')
+if latent_seed not in ['auto', None]:
+    latent_seed = int(latent_seed) + rank
+latent = LatentSampler(n_noise_features, batch_size, device,
+                       config.get('latent_block_steps', 1), latent_seed)
+
+# Create the result directory, only rank 0 writes to it and decides for all
+# the processes whether to go on
 if not resume_training:
-    result_dir = '{}_e{}_d{}_g{}/'.format(
-        datetime.datetime.now().strftime('%y-%m-%d_%H-%M'),
-        epochs,
-        discriminator_filters,
-        generator_filters
-    )
-    if not os.path.isdir(result_dir):
-        os.makedirs(result_dir)
-    else:
-        print('The result directory {} already exists, ABORTING')
+    result_dir = None
+    if rank == 0:
+        # Named after the date and the filters unless set in the config
+        result_dir = config.get('result_dir', 'auto')
+        if result_dir == 'auto':
+            result_dir = '{}_e{}_d{}_g{}/'.format(
+                datetime.datetime.now().strftime('%y-%m-%d_%H-%M'),
+                epochs,
+                discriminator_filters,
+                generator_filters
+            )
+        result_dir = os.path.join(result_dir, '')
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+            # Copy the config.yml to result directory
+            shutil.copy2(config_file, '{}config.yml'.format(result_dir))
+        else:
+            print('The result directory {} already exists, ABORTING'.format(result_dir))
+            result_dir = None
+    # None when rank 0 aborts, every process exits then
+    result_dir = broadcast_object(result_dir)
+    if result_dir is None:
+        close_distributed()
         sys.exit(-1)
 
-    # Copy the config.yml to result directory
-    shutil.copy2('config.yml', '{}config.yml'.format(result_dir))
-
     # Create the directory for the frames of the epochs
     video_dir = '{}video/'.format(result_dir)
-    if not os.path.isdir(video_dir):
+    if rank == 0 and not os.path.isdir(video_dir):
         os.makedirs(video_dir)
 else:
     result_dir = args.resume_from_folder
     video_dir = '{}video/'.format(args.resume_from_folder)
 
-writer = SummaryWriter(log_dir='{}tensorboard'.format(result_dir))
-
-discriminator = Discriminator(image_size[0], discriminator_filters).to(device)
+# A resumed run carries on the epoch numbering of the runs before it, kept
+# in summary.yml, so that its frames continue the animation
+start_epoch = 0
+if resume_training:
+    start_epoch = epochs
+    if os.path.isfile('{}summary.yml'.format(result_dir)):
+        with open('{}summary.yml'.format(result_dir), 'r') as f:
+            start_epoch = int(load(f, Loader).get('epochs_trained', epochs))
+
+writer = None
+if rank == 0:
+    writer = Lazy('SummaryWriter', lambda: tensorboardX.SummaryWriter(
+        log_dir='{}tensorboard'.format(result_dir)))
+if renderer is not None and config.get('frame_gif', False):
+    renderer.start_gif('{}{}.gif'.format(video_dir, dataset.lower()), resume_training)
+# Checkpoints and frames written in the background with async_checkpoints,
+# all the plotting during training happens in its thread
+checkpoint_writer = CheckpointWriter(config.get('async_checkpoints', False))
+
+discriminator = Discriminator(
+    image_size[0], discriminator_filters, image_size=image_size).to(device)
 generator = Generator(
-    n_noise_features, image_size[0], generator_filters).to(device)
+    n_noise_features, image_size[0], generator_filters, image_size=image_size).to(device)
 if resume_training:
     discriminator.load_state_dict(torch.load('{}discriminator.pt'.format(result_dir)))
     generator.load_state_dict(torch.load('{}generator.pt'.format(result_dir)))
@@ -364,7 +527,27 @@ else:
     discriminator.weight_init(mean=0.0, std=0.02)
     generator.weight_init(mean=0.0, std=0.02)
 
-print('Discriminator\n{}\n\nGenerator\n{}'.format(discriminator, generator))
+# Activation checkpointing of the selected conv segments
+checkpoint_segments(discriminator, discriminator_checkpoint_segments)
+checkpoint_segments(generator, generator_checkpoint_segments)
+
+# Forward passes under autocast with bf16/fp16, loss scaling with fp16
+amp = MixedPrecision(precision, device)
+amp.wrap(discriminator)
+amp.wrap(generator)
+disc_scaler, gen_scaler = amp.scaler(), amp.scaler()
+# Opt-in channels_last memory format and torch.compile
+prepare_model(discriminator, channels_last, compile_models)
+prepare_model(generator, channels_last, compile_models)
+# Parameters clipped, frozen and unfrozen with single calls
+disc_params, gen_params = ParamGroup(discriminator), ParamGroup(generator)
+# Same initial weights on every process, gradients averaged before each step
+disc_sync = GradientAllReduce(discriminator, world_size)
+gen_sync = GradientAllReduce(generator, world_size)
+
+if rank == 0:
+    print('Discriminator\n{}\n\nGenerator\n{}'.format(discriminator, generator))
+timer.mark('models')
 
 disc_optimizer = torch.optim.Adam(
     discriminator.parameters(), lr=0.0001, betas=(0, 0.9))
@@ -374,125 +557,186 @@ gen_optimizer = torch.optim.Adam(
 # iterator, train_loader = get_train_loader(batch_size)
 train_loader, test_loader = load_dataset(batch_size,
                                          dataset,
-                                         image_size[1])
-
-images = iter(train_loader).next()[0]
-img = images.numpy()
-print('Max: {}\tMin: {}\tMean: {}\tStd: {}'.format(
-    np.max(img),
-    np.min(img),
-    (np.mean(img[:, 0]), np.mean(img[:, 1]), np.mean(img[:, 2])),
-    (np.std(img[:, 0]), np.std(img[:, 1]), np.std(img[:, 2]))
-))
-print('Image size: {}'.format(images[0].shape))
-fig = plt.figure(figsize=(10, 10))
-imshow(images)
-plt.show()
-plt.close(fig)
+                                         image_size[1],
+                                         data_format,
+                                         dataloader_options(config, device),
+                                         fast_decode,
+                                         rank,
+                                         world_size)
+batch_transform = BatchTransform(hflip=dataset == 'POKEMON', channels_last=channels_last)
+timer.mark('dataset')
+
+# Split of the cores between compute threads and loader workers, measured on
+# a few steps of the models and written to the config.yml of the results.
+# The critic steps are timed with the loss of training, gradient penalty
+# included. Only rank 0 measures, so that the local processes do not compete
+# for the cores, and every process uses its choice.
+if config.get('tune_threads', False):
+    threads, num_workers = None, None
+    if rank == 0:
+        threads, num_workers = tune_threads(
+            discriminator, generator, n_noise_features, batch_size, image_size, device,
+            train_loader, 1, 1 / config['disc_steps'], channels_last,
+            lambda real, fake, penalty_step: disc_scaler.scale(critic_loss(real, fake, penalty_step)[0]),
+            gp_every)
+    threads, num_workers = broadcast_object((threads, num_workers))
+    torch.set_num_threads(threads)
+    if isinstance(train_loader, torch.utils.data.DataLoader):
+        train_loader = with_options(
+            train_loader, dataloader_options(dict(config, num_workers=num_workers), device))
+    if rank == 0:
+        record_config('{}config.yml'.format(result_dir), {
+            'threads_per_process': threads, 'num_workers': num_workers, 'tune_threads': False})
+    timer.mark('thread tuning')
+
+# Preview a batch, skipped in headless mode and on the other processes
+if not headless and rank == 0:
+    images = batch_transform(next(iter(train_loader))[0])
+    img = images.numpy()
+    print('Max: {}\tMin: {}\tMean: {}\tStd: {}'.format(
+        np.max(img),
+        np.min(img),
+        (np.mean(img[:, 0]), np.mean(img[:, 1]), np.mean(img[:, 2])),
+        (np.std(img[:, 0]), np.std(img[:, 1]), np.std(img[:, 2]))
+    ))
+    print('Image size: {}'.format(images[0].shape))
+    fig = plt.figure(figsize=(10, 10))
+    imshow(images)
+    plt.show()
+    plt.close(fig)
+    timer.mark('preview')
+
+# Fixed-size batches already on the device, loaded in the background
+batches = InfiniteBatches(train_loader, device, batch_size,
+                          prefetch_batches, batch_transform)
+if steps_per_epoch == 'auto':
+    steps_per_epoch = num_batches(train_loader, batch_size)
+if rank == 0:
+    timer.report()
 
 disc_losses, gen_losses, w_distances, gradient_penalty_list = [], [], [], []
+# Losses are kept on the device and flushed every flush_metrics_every steps
+# and averaged over the processes
+metrics = MetricAccumulator(writer, config.get('flush_metrics_every', 100), world_size > 1)
 gen_iterations = 0
 steps = 0
-frame_noise = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-    dtype=torch.FloatTensor).to(device)
+frame_noise = latent.sample().clone()
+train_start = time.time()
 
 for e in range(epochs):
-    if e % print_every == 0:
+    if e % print_every == 0 and rank == 0:
         print('Epoch {}'.format(e))
     start = time.time()
     epoch_dlosses, epoch_glosses = [], []
-    train_iterator = iter(train_loader)
+    batches.reset()
     i = 0
-    while i < len(train_loader):
+    while i < steps_per_epoch:
         noise_factor = (epochs - e) / epochs
         #########################
         # Train the discriminator
         #########################
-        for p in discriminator.parameters():  # reset requires_grad
-            p.requires_grad = True
+        disc_params.unfreeze()
         # train the discriminator disc_steps times
         if gen_iterations < 25 or gen_iterations % 500 == 0:
             disc_steps = 100
         else:
             disc_steps = config['disc_steps']
         j = 0
-        while j < disc_steps and i < len(train_loader):
+        while j < disc_steps and i < steps_per_epoch:
             j += 1
             i += 1
-            images, _ = train_iterator.next()
-            images = images.to(device)
-            common_batch_size = min(batch_size, images.shape[0])
-            disc_optimizer.zero_grad()
-            noises = torch.from_numpy(np.random.randn(common_batch_size, n_noise_features)).type(
-                dtype=torch.FloatTensor).to(device)
+            images, _ = next(batches)
+            disc_optimizer.zero_grad(set_to_none=True)
+            noises = latent.sample()
             # Compute output of both the discriminator and generator
-            disc_output = discriminator(images)
-            gen_images = generator(noises)
-            gen_output = discriminator(gen_images)
-            #disc_output.backward(torch.ones(common_batch_size, 1).to(device))
-            #gen_output.backward(- torch.ones(common_batch_size, 1).to(device))
-            gradient_penalty = compute_gradient_penalty(images, gen_images, discriminator, lambda_pen)
-            loss = torch.mean(gen_output - disc_output + gradient_penalty)
-            loss.backward()
-            wdist = torch.mean(disc_output - gen_output)
-            disc_optimizer.step()
+            # The critic step does not update the generator, so its fakes are
+            # produced without building an autograd graph
+            with torch.no_grad():
+                gen_images = generator(noises)
+            penalty_step = steps % gp_every == 0
+            loss, wdist, gradient_penalty = 0, 0, 0
+            for real, fake in zip(images.chunk(micro_batches), gen_images.chunk(micro_batches)):
+                # Each micro-batch adds its share of the batch loss to the
+                # gradients, the penalty is per sample so it splits exactly
+                weight = real.shape[0] / images.shape[0]
+                mb_loss, mb_wdist, mb_penalty = critic_loss(real, fake, penalty_step)
+                disc_scaler.scale(mb_loss * weight).backward()
+                loss = loss + mb_loss.detach() * weight
+                wdist = wdist + mb_wdist.detach() * weight
+                if penalty_step:
+                    gradient_penalty = gradient_penalty + mb_penalty.detach() * weight
+            disc_sync.sync()
+            disc_scaler.step(disc_optimizer)
+            disc_scaler.update()
 
             # Save the loss
             #disc_losses.append(torch.mean(errD).item())
             #epoch_dlosses.append(torch.mean(errD).item())
             #writer.add_scalar('data/D_loss', torch.mean(errD).item(), steps)
-            disc_losses.append(loss.item())
-            epoch_dlosses.append(loss.item())
-            w_distances.append(wdist.item())
-            gradient_penalty_list.append(torch.mean(gradient_penalty).item())
-            writer.add_scalar('data/D_loss', loss.item(), steps)
-            writer.add_scalar('data/gradient_penalty', torch.mean(gradient_penalty).item(), steps)
-            writer.add_scalar('data/Wasserstein_distance_estimate', wdist.item(), steps)
+            metrics.add(loss, [disc_losses, epoch_dlosses], 'data/D_loss', steps)
+            metrics.add(wdist, [w_distances], 'data/Wasserstein_distance_estimate', steps)
+            if penalty_step:
+                metrics.add(gradient_penalty, [gradient_penalty_list],
+                            'data/gradient_penalty', steps)
             steps += 1
+            metrics.step()
 
         #######################
         # Train the generator
         #######################
         # print('Training generator {} {}'.format(gen_iterations, i))
-        for p in discriminator.parameters():  # reset requires_grad
-            p.requires_grad = False
-        gen_optimizer.zero_grad()
-        noises = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-            dtype=torch.FloatTensor).to(device)
-        gen_images = generator(noises)
-        gen_output = discriminator(gen_images)
-        # gen_output.backward(torch.ones(batch_size, 1).to(device))
-        loss = - torch.mean(gen_output)
-        loss.backward()
-        gen_optimizer.step()
+        disc_params.freeze()
+        gen_optimizer.zero_grad(set_to_none=True)
+        loss = 0
+        for noises in latent.sample().chunk(micro_batches):
+            gen_images = generator(noises)
+            gen_output = discriminator(gen_images)
+            # gen_output.backward(torch.ones(batch_size, 1).to(device))
+            mb_loss = - torch.mean(gen_output) * (noises.shape[0] / batch_size)
+            gen_scaler.scale(mb_loss).backward()
+            loss = loss + mb_loss.detach()
+        gen_sync.sync()
+        gen_scaler.step(gen_optimizer)
+        gen_scaler.update()
         # Save the loss
         # gen_losses.append(torch.mean(gen_output).item())
         # epoch_glosses.append(torch.mean(gen_output).item())
         # writer.add_scalar('data/G_loss', torch.mean(gen_output).item(), gen_iterations)
-        gen_losses.append(loss.item())
-        epoch_glosses.append(loss.item())
-        writer.add_scalar('data/G_loss', loss.item(), gen_iterations)
+        metrics.add(loss, [gen_losses, epoch_glosses], 'data/G_loss', gen_iterations)
         # print('------------', gen_loss.item(), np.mean(temp3))
         # print([x.grad for x in list(generator.parameters())])
         gen_iterations += 1
+    metrics.flush()
+    images_per_second = len(epoch_dlosses) * batch_size * world_size / (time.time() - start)
+    if rank != 0:
+        # Frames, checkpoints and logs are written by rank 0
+        continue
+    writer.add_scalar('data/critic_images_per_second', images_per_second, start_epoch + e)
     if e % print_every == 0:
-        generate_frame(discriminator, generator, e, frame_noise)
-        print('D loss: {:.5f}\tG loss: {:.5f}\tTime: {:.0f}'.format(
-            np.mean(epoch_dlosses), np.mean(epoch_glosses), time.time() - start))
+        generate_frame(discriminator, generator, start_epoch + e, frame_noise)
+        print('D loss: {:.5f}\tG loss: {:.5f}\tTime: {:.0f}\tData wait: {:.1f}\tImages/s: {:.0f}'.format(
+            np.mean(epoch_dlosses), np.mean(epoch_glosses), time.time() - start,
+            batches.wait_time, images_per_second))
     if e % checkpoints == 0:
-        checkpoint(discriminator, generator, e)
-
-
+        checkpoint(discriminator, generator, start_epoch + e)
+
+
+batches.close()
+checkpoint_writer.close()
+if renderer is not None:
+    renderer.close()
+train_time = time.time() - train_start
+if rank != 0:
+    # Testing, plots and final models are left to rank 0
+    close_distributed()
+    sys.exit(0)
 print('\nTesting...')
-for p in discriminator.parameters():  # reset requires_grad
-    p.requires_grad = False
-for p in generator.parameters():  # reset requires_grad
-    p.requires_grad = False
+disc_params.freeze()
+gen_params.freeze()
 disc_accs, gen_accs = [], []
 for test, _ in train_loader:
-    test = test.to(device)
-    noises = torch.from_numpy(np.random.randn(batch_size, n_noise_features)).type(
-        dtype=torch.FloatTensor).to(device)
+    test = batch_transform(test.to(device, non_blocking=True))
+    noises = latent.sample()
     disc_output = discriminator(test).detach().to('cpu')
     gen_output = generator(noises).detach()
     # print(disc_output.shape, gen_output.to('cpu').shape)
@@ -502,6 +746,17 @@ for test, _ in train_loader:
 
 print('Discriminator accuracy on real data: {}\nDiscriminator accuracy on generated data: {}'.format(
     np.mean(disc_accs), 1 - np.mean(gen_accs)))
+write_summary(result_dir, {
+    'd_loss': np.mean(epoch_dlosses),
+    'g_loss': np.mean(epoch_glosses),
+    'wasserstein_distance': np.mean(w_distances[-rolling_window:]),
+    'gradient_penalty': np.mean(gradient_penalty_list[-rolling_window:]),
+    'real_accuracy': np.mean(disc_accs),
+    'generated_accuracy': 1 - np.mean(gen_accs),
+    'images_per_second': images_per_second,
+    'train_time': train_time,
+    'epochs_trained': start_epoch + epochs
+})
 
 
 # Plot 16 generated images
@@ -523,7 +778,8 @@ plot_results(result_dir, disc_losses, gen_losses, w_distances, gradient_penalty_
 
 # Save the models
 disc_dict = discriminator.state_dict()
-torch.save(disc_dict, '{}discriminator.pt'.format(result_dir))
+atomic_save(disc_dict, '{}discriminator.pt'.format(result_dir))
 
 gen_dict = generator.state_dict()
-torch.save(gen_dict, '{}generator.pt'.format(result_dir))
+atomic_save(gen_dict, '{}generator.pt'.format(result_dir))
+close_distributed()
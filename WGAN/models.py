@@ -0,0 +1,85 @@
+import os
+import sys
+
+from torch import nn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.fused import SplitBatchNorm2d
+
+
+class Discriminator(nn.Module):
+    def __init__(self, input_channels, nf, image_size=(3, 64, 64)):
+        super(Discriminator, self).__init__()
+        self.flattened_size = 64 * \
+            (image_size[1]//2//2//2) * (image_size[2]//2//2//2)
+        self.conv_block = nn.Sequential(
+            # input is (3, 32, 32)
+            nn.Conv2d(input_channels, nf, 4, padding=1, stride=2, bias=False),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+
+            # input is (nf, 16, 16)
+            nn.Conv2d(nf, nf * 2, 4, padding=1, stride=2, bias=False),
+            SplitBatchNorm2d(nf * 2),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+
+            # input is (nf*2, 8, 8)
+            nn.Conv2d(nf * 2, nf * 4, 4, padding=1, stride=2, bias=False),
+            SplitBatchNorm2d(nf * 4),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+
+            nn.Conv2d(nf * 4, nf * 8, 4, padding=1, stride=2, bias=False),
+            SplitBatchNorm2d(nf * 8),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+
+            # input is (nf*4, 4, 4)
+            nn.Conv2d(nf * 8, 1, 4, padding=0, stride=1, bias=False),
+        )
+
+    def forward(self, x):
+        x = self.conv_block(x)
+        return x.view(-1, 1)
+
+    def weight_init(self, mean, std):
+        for m in self._modules:
+            normal_init(self._modules[m], mean, std)
+
+
+class Generator(nn.Module):
+    def __init__(self, input_size, output_channels, nf=128, image_size=(3, 64, 64)):
+        super(Generator, self).__init__()
+
+        self.conv_block = nn.Sequential(
+            nn.ConvTranspose2d(input_size, nf*8, 4, stride=1, padding=0, bias=False),
+            nn.BatchNorm2d(nf*8),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+
+            nn.ConvTranspose2d(nf*8, nf*4, 4, stride=2, padding=1, bias=False),
+            nn.BatchNorm2d(nf*4),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+
+            nn.ConvTranspose2d(nf*4, nf*2, 4, stride=2, padding=1, bias=False),
+            nn.BatchNorm2d(nf*2),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+
+            nn.ConvTranspose2d(nf*2, nf, 4, stride=2, padding=1, bias=False),
+            nn.BatchNorm2d(nf),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+
+            nn.ConvTranspose2d(nf, output_channels, 4, stride=2, padding=1, bias=False),
+            nn.Tanh(),
+        )
+
+    def forward(self, x):
+        x = x.view(x.shape[0], x.shape[1], 1, 1)
+        x = self.conv_block(x)
+        return x
+
+    def weight_init(self, mean, std):
+        for m in self._modules:
+            normal_init(self._modules[m], mean, std)
+
+
+def normal_init(m, mean, std):
+    if isinstance(m, nn.ConvTranspose2d) or isinstance(m, nn.Conv2d):
+        m.weight.data.normal_(mean, std)
+        m.bias.data.zero_()
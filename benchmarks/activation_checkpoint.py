@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import argparse
+import resource
+import multiprocessing
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.activation_checkpoint import checkpoint_segments
+from execution import load_models, training_step
+
+
+def run(args, discriminator_segments, generator_segments, queue):
+    # Runs in a fresh process, so that its peak memory only covers this choice
+    device = torch.device(args.device)
+    models = load_models(args.model)
+    torch.manual_seed(0)
+    image_shape = (3, args.image_size, args.image_size)
+    discriminator = models.Discriminator(
+        image_shape[0], args.discriminator_filters, image_size=image_shape).to(device)
+    generator = models.Generator(
+        args.n_noise_features, image_shape[0], args.generator_filters, image_size=image_shape).to(device)
+    checkpoint_segments(discriminator, discriminator_segments)
+    checkpoint_segments(generator, generator_segments)
+    disc_optimizer = torch.optim.Adam(discriminator.parameters(), lr=1e-4)
+    gen_optimizer = torch.optim.Adam(generator.parameters(), lr=1e-4)
+    images = torch.rand(args.batch_size, *image_shape, device=device) * 2 - 1
+    noises = torch.randn(args.batch_size, args.n_noise_features, device=device)
+
+    def step():
+        training_step(generator, discriminator, disc_optimizer, gen_optimizer, images, noises,
+                      args.model == 'WGAN-GP', False)
+
+    # Activations kept for backward, each storage counted once
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+    saved = sum(storages.values()) / 2**20
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        # ru_maxrss is in KB on Linux
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 2**10
+    queue.put(((time.perf_counter() - start) / args.n_steps, saved, peak))
+
+
+def measure(args, discriminator_segments, generator_segments):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run, args=(args, discriminator_segments, generator_segments, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='WGAN-GP', choices=['WGAN-GP', 'WGAN', 'DCGAN'])
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--n_noise_features', type=int, default=100)
+    parser.add_argument('--discriminator_filters', type=int, default=128)
+    parser.add_argument('--generator_filters', type=int, default=128)
+    parser.add_argument('--n_steps', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    # Large blocks are mmapped and given back to the OS when freed, so the
+    # peak RSS follows the peak of live tensors
+    os.environ.setdefault('MALLOC_MMAP_THRESHOLD_', '65536')
+    models = load_models(args.model)
+    image_shape = (3, args.image_size, args.image_size)
+    n_disc = checkpoint_segments(models.Discriminator(3, 1, image_size=image_shape), [])
+    n_gen = checkpoint_segments(models.Generator(1, 3, 1, image_size=image_shape), [])
+    # Single segments, then growing regions of consecutive segments
+    choices = [('none', [], [])]
+    choices += [('discriminator {}'.format([i]), [i], []) for i in range(n_disc)]
+    choices += [('discriminator {}'.format(list(range(i))), list(range(i)), []) for i in range(2, n_disc)]
+    choices += [('generator {}'.format([i]), [], [i]) for i in range(n_gen)]
+    choices += [('generator {}'.format(list(range(i))), [], list(range(i))) for i in range(2, n_gen)]
+    choices += [('discriminator all', 'all', []), ('generator all', [], 'all'), ('both all', 'all', 'all')]
+
+    memory = 'peak CUDA memory' if args.device.startswith('cuda') else 'peak RSS increase'
+    print('Model: {}\tImage size: {}\tBatch size: {}\tFilters: {}/{}\tDevice: {}'.format(
+        args.model, args.image_size, args.batch_size, args.discriminator_filters,
+        args.generator_filters, args.device))
+    print('{:<30}{:>10}{:>8}{:>22}{:>22}'.format(
+        'segments', 'ms/step', 'time', 'saved for backward', memory))
+    baseline = None
+    for name, discriminator_segments, generator_segments in choices:
+        step_time, saved, peak = measure(args, discriminator_segments, generator_segments)
+        baseline = baseline or (step_time, saved)
+        print('{:<30}{:>10.0f}{:>7.2f}x{:>12.0f} MB ({:>3.0f}%){:>19.0f} MB'.format(
+            name, step_time * 1000, step_time / baseline[0], saved,
+            100 * saved / baseline[1], peak))
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import argparse
+import importlib.util
+
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from utils.amp import MixedPrecision
+
+
+def load_models(folder):
+    # The model folders are not packages, load their models.py by path
+    path = os.path.join(ROOT, folder, 'models.py')
+    spec = importlib.util.spec_from_file_location(folder.replace('-', '_') + '_models', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def critic_step(generator, discriminator, optimizer, scaler, images, noises, no_grad):
+    optimizer.zero_grad()
+    if no_grad:
+        with torch.no_grad():
+            gen_images = generator(noises)
+    else:
+        gen_images = generator(noises)
+    loss = torch.mean(discriminator(gen_images) - discriminator(images))
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+
+
+def saved_bytes(step):
+    # Size of the tensors kept alive for the backward pass during one step
+    total = [0]
+
+    def pack(tensor):
+        total[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+    return total[0]
+
+
+def time_steps(step, n_steps, device):
+    for _ in range(3):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_steps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='WGAN-GP', choices=['WGAN-GP', 'WGAN', 'DCGAN'])
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--n_noise_features', type=int, default=100)
+    parser.add_argument('--discriminator_filters', type=int, default=64)
+    parser.add_argument('--generator_filters', type=int, default=64)
+    parser.add_argument('--n_steps', type=int, default=20)
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    models = load_models(args.model)
+    image_size = (3, args.image_size, args.image_size)
+    discriminator = models.Discriminator(
+        image_size[0], args.discriminator_filters, image_size=image_size).to(device)
+    generator = models.Generator(
+        args.n_noise_features, image_size[0], args.generator_filters, image_size=image_size).to(device)
+    amp = MixedPrecision(args.precision, device)
+    amp.wrap(discriminator)
+    amp.wrap(generator)
+    scaler = amp.scaler()
+    optimizer = torch.optim.Adam(discriminator.parameters(), lr=1e-4)
+    images = torch.rand(args.batch_size, *image_size, device=device) * 2 - 1
+    noises = torch.randn(args.batch_size, args.n_noise_features, device=device)
+
+    print('Model: {}\tImage size: {}\tBatch size: {}\tPrecision: {}\tDevice: {}'.format(
+        args.model, args.image_size, args.batch_size, args.precision, device))
+    results = {}
+    for name, no_grad in [('generator with autograd', False), ('generator under no_grad', True)]:
+        def step():
+            critic_step(generator, discriminator, optimizer, scaler, images, noises, no_grad)
+        saved = saved_bytes(step)
+        step_time = time_steps(step, args.n_steps, device)
+        results[no_grad] = step_time, saved
+        line = '{}: {:.1f} ms/step\tSaved for backward: {:.1f} MB'.format(
+            name, step_time * 1000, saved / 2**20)
+        if device.type == 'cuda':
+            line += '\tPeak memory: {:.1f} MB'.format(torch.cuda.max_memory_allocated() / 2**20)
+        print(line)
+    print('Speedup: {:.2f}x\tSaved memory reduced by {:.0f}%'.format(
+        results[False][0] / results[True][0], 100 * (1 - results[True][1] / results[False][1])))
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import torchvision
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.fast_decode import DraftLoader
+
+
+def time_loader(samples, load):
+    images = []
+    start = time.perf_counter()
+    for path, _ in samples:
+        images.append(np.asarray(load(path), dtype=np.float32))
+    return time.perf_counter() - start, images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_folder', type=str, default='../data/img_align_celeba/')
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--n_images', type=int, default=2000)
+    args = parser.parse_args()
+
+    samples = torchvision.datasets.ImageFolder(root=args.image_folder).samples
+    samples = samples[:args.n_images]
+
+    # Current path: full resolution decode followed by Resize
+    resize = torchvision.transforms.Resize((args.image_size, args.image_size))
+
+    def default_load(path):
+        return resize(torchvision.datasets.folder.default_loader(path))
+
+    # Warm up the OS file cache, so that both loaders read from memory
+    time_loader(samples, default_load)
+    default_time, default_images = time_loader(samples, default_load)
+    draft_time, draft_images = time_loader(samples, DraftLoader(args.image_size))
+
+    error = np.mean([np.mean(np.abs(a - b)) for a, b in zip(default_images, draft_images)])
+    print('Images: {}\tSize: {}x{}'.format(len(samples), args.image_size, args.image_size))
+    print('Full decode + Resize: {:.0f} images/s'.format(len(samples) / default_time))
+    print('Draft decode + resize: {:.0f} images/s'.format(len(samples) / draft_time))
+    print('Speedup: {:.2f}x\tMean absolute pixel difference: {:.2f}/255'.format(
+        default_time / draft_time, error))
@@ -0,0 +1,110 @@
+import os
+import sys
+import time
+import argparse
+import importlib.util
+
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from utils.execution import prepare_model, eager
+
+
+def load_models(folder):
+    # The model folders are not packages, load their models.py by path
+    path = os.path.join(ROOT, folder, 'models.py')
+    spec = importlib.util.spec_from_file_location(folder.replace('-', '_') + '_models', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def training_step(generator, discriminator, disc_optimizer, gen_optimizer, images, noises,
+                  gradient_penalty, compiled):
+    # One critic step, with the WGAN-GP penalty if asked, and one generator step
+    disc_optimizer.zero_grad()
+    with torch.no_grad():
+        gen_images = generator(noises)
+    loss = torch.mean(discriminator(gen_images) - discriminator(images))
+    if gradient_penalty:
+        alpha = torch.rand(images.shape[0], 1, 1, 1, device=images.device)
+        x_hat = (alpha * images + (1 - alpha) * gen_images).requires_grad_(True)
+        with eager(compiled):
+            out = discriminator(x_hat)
+        gradients = torch.autograd.grad(out.sum(), x_hat, create_graph=True)[0]
+        loss = loss + 10 * torch.mean((gradients.reshape(gradients.shape[0], -1).norm(2, dim=1) - 1) ** 2)
+    loss.backward()
+    disc_optimizer.step()
+
+    gen_optimizer.zero_grad()
+    loss = - torch.mean(discriminator(generator(noises)))
+    loss.backward()
+    gen_optimizer.step()
+
+
+def benchmark(models, args, image_size, channels_last, compiled, device):
+    torch.manual_seed(0)
+    image_shape = (3, image_size, image_size)
+    discriminator = models.Discriminator(
+        image_shape[0], args.discriminator_filters, image_size=image_shape).to(device)
+    generator = models.Generator(
+        args.n_noise_features, image_shape[0], args.generator_filters, image_size=image_shape).to(device)
+    prepare_model(discriminator, channels_last, compiled)
+    prepare_model(generator, channels_last, compiled)
+    disc_optimizer = torch.optim.Adam(discriminator.parameters(), lr=1e-4)
+    gen_optimizer = torch.optim.Adam(generator.parameters(), lr=1e-4)
+    images = torch.rand(args.batch_size, *image_shape, device=device) * 2 - 1
+    if channels_last:
+        images = images.contiguous(memory_format=torch.channels_last)
+    noises = torch.randn(args.batch_size, args.n_noise_features, device=device)
+
+    def step():
+        training_step(generator, discriminator, disc_optimizer, gen_optimizer, images, noises,
+                      args.model == 'WGAN-GP', compiled)
+
+    # The first steps include the compilation
+    start = time.perf_counter()
+    for _ in range(args.warmup_steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    warmup_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.n_steps, warmup_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='WGAN-GP', choices=['WGAN-GP', 'WGAN', 'DCGAN'])
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[64, 128])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--n_noise_features', type=int, default=100)
+    parser.add_argument('--discriminator_filters', type=int, default=64)
+    parser.add_argument('--generator_filters', type=int, default=64)
+    parser.add_argument('--warmup_steps', type=int, default=3)
+    parser.add_argument('--n_steps', type=int, default=10)
+    parser.add_argument('--no_compile', action='store_true')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    models = load_models(args.model)
+    modes = [('eager NCHW', False, False), ('eager channels_last', True, False)]
+    if not args.no_compile:
+        modes += [('compiled NCHW', False, True), ('compiled channels_last', True, True)]
+    print('Model: {}\tBatch size: {}\tDevice: {}'.format(args.model, args.batch_size, device))
+    for image_size in args.image_sizes:
+        if args.model != 'WGAN-GP' and image_size != 64:
+            print('{}x{}: only WGAN-GP has a 128x128 generator, skipped'.format(image_size, image_size))
+            continue
+        baseline = None
+        for name, channels_last, compiled in modes:
+            step_time, warmup_time = benchmark(models, args, image_size, channels_last, compiled, device)
+            baseline = baseline or step_time
+            print('{}x{} {}: {:.1f} ms/step\tSpeedup: {:.2f}x\tWarmup: {:.1f}s'.format(
+                image_size, image_size, name, step_time * 1000, baseline / step_time, warmup_time))
@@ -0,0 +1,16 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+
+def make_image_folder(root, n_per_class=(5, 4), size=12, ext='.png'):
+    # ImageFolder layout with random RGB images, one folder per class
+    rng = np.random.RandomState(0)
+    for c, n in enumerate(n_per_class):
+        class_dir = os.path.join(root, 'class_{}'.format(c))
+        os.makedirs(class_dir)
+        for i in range(n):
+            pixels = rng.randint(0, 256, (size, size + i, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(class_dir, '{:03d}{}'.format(i, ext)))
+    return root
@@ -0,0 +1,62 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+
+from utils.activation_checkpoint import checkpoint_segments
+
+
+class Critic(nn.Module):
+    def __init__(self):
+        super(Critic, self).__init__()
+        self.main = nn.Sequential(
+            nn.Conv2d(3, 4, 3, padding=1), nn.LeakyReLU(0.2, inplace=True),
+            nn.Conv2d(4, 8, 3, stride=2, padding=1), nn.BatchNorm2d(8), nn.LeakyReLU(0.2, inplace=True),
+            nn.Conv2d(8, 8, 3, stride=2, padding=1), nn.BatchNorm2d(8), nn.LeakyReLU(0.2, inplace=True))
+        self.output = nn.Sequential(nn.Flatten(), nn.Linear(8 * 2 * 2, 1))
+
+    def forward(self, x):
+        return self.output(self.main(x))
+
+
+def wgan_gp_loss(critic, real, fake, alpha):
+    x_hat = (alpha * real + (1 - alpha) * fake).requires_grad_(True)
+    out = critic(x_hat)
+    gradients = torch.autograd.grad(out, x_hat, torch.ones_like(out), create_graph=True)[0]
+    penalty = ((gradients.reshape(gradients.shape[0], -1).norm(2, dim=1) - 1) ** 2).mean()
+    return torch.mean(critic(fake) - critic(real)) + 10 * penalty
+
+
+@pytest.mark.parametrize('selected', ['all', [1], [0, 2]])
+def test_gradients_and_running_stats_match_the_plain_model(selected):
+    torch.manual_seed(0)
+    plain = Critic()
+    segmented = copy.deepcopy(plain)
+    assert checkpoint_segments(segmented, selected) == 4
+    real, fake, alpha = torch.randn(6, 3, 8, 8), torch.randn(6, 3, 8, 8), torch.rand(6, 1, 1, 1)
+    for _ in range(2):
+        for model in (plain, segmented):
+            model.zero_grad()
+            wgan_gp_loss(model, real, fake, alpha).backward()
+        for p, q in zip(plain.parameters(), segmented.parameters()):
+            assert torch.allclose(p.grad, q.grad, atol=1e-5)
+        # Recomputation in backward does not update the running stats again
+        for name, buffer in plain.named_buffers():
+            assert torch.allclose(buffer, dict(segmented.named_buffers())[name], atol=1e-6), name
+    # Three forward passes per loss
+    assert plain.main[3].num_batches_tracked.item() == 2 * 3
+
+
+def test_eval_and_no_grad_run_unchanged():
+    torch.manual_seed(0)
+    plain = Critic()
+    segmented = copy.deepcopy(plain)
+    checkpoint_segments(segmented, 'all')
+    x = torch.randn(2, 3, 8, 8)
+    with torch.no_grad():
+        assert torch.allclose(plain(x), segmented(x))
+    plain.eval()
+    segmented.eval()
+    assert torch.allclose(plain(x), segmented(x))
+    assert plain.state_dict().keys() == segmented.state_dict().keys()
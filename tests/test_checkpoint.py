@@ -0,0 +1,76 @@
+import os
+
+import pytest
+import torch
+
+from utils.checkpoint import CheckpointWriter, atomic_dir, atomic_save, snapshot
+
+
+def test_atomic_save(tmp_path):
+    path = str(tmp_path / 'model.pth')
+    atomic_save({'a': torch.arange(3)}, path)
+    atomic_save({'a': torch.arange(4)}, path)
+    assert torch.equal(torch.load(path)['a'], torch.arange(4))
+    assert os.listdir(tmp_path) == ['model.pth']
+
+
+def test_atomic_save_keeps_the_old_file_on_error(tmp_path):
+    path = str(tmp_path / 'model.pth')
+    atomic_save({'a': torch.arange(3)}, path)
+    with pytest.raises(Exception):
+        atomic_save({'a': lambda: None}, path)
+    assert torch.equal(torch.load(path)['a'], torch.arange(3))
+
+
+def test_atomic_dir_replaces_the_directory(tmp_path):
+    path = str(tmp_path / 'checkpoint')
+    for name in ['old', 'new']:
+        with atomic_dir(path) as tmp_dir:
+            assert tmp_dir.endswith(os.sep)
+            assert not os.path.exists(os.path.join(path, name))
+            with open('{}{}'.format(tmp_dir, name), 'w') as f:
+                f.write(name)
+    assert os.listdir(path) == ['new']
+    assert sorted(os.listdir(tmp_path)) == ['checkpoint']
+
+
+def test_atomic_dir_keeps_the_old_directory_on_error(tmp_path):
+    path = str(tmp_path / 'checkpoint')
+    with atomic_dir(path) as tmp_dir:
+        open('{}old'.format(tmp_dir), 'w').close()
+    with pytest.raises(RuntimeError):
+        with atomic_dir(path) as tmp_dir:
+            open('{}new'.format(tmp_dir), 'w').close()
+            raise RuntimeError()
+    assert os.listdir(path) == ['old']
+    # The partial directory is cleared by the next write
+    with atomic_dir(path) as tmp_dir:
+        assert os.listdir(tmp_dir) == []
+
+
+def test_snapshot_is_a_copy():
+    module = torch.nn.Linear(2, 2)
+    state = snapshot(module)
+    with torch.no_grad():
+        module.weight.add_(1)
+    assert not torch.equal(state['weight'], module.weight)
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_writer_runs_jobs_in_order_and_raises_errors(background):
+    writer = CheckpointWriter(background=background, max_in_flight=1)
+    done = []
+    for i in range(5):
+        writer.submit(done.append, i)
+
+    def fail():
+        raise OSError('disk full')
+    if background:
+        writer.submit(fail)
+        with pytest.raises(OSError):
+            writer.close()
+    else:
+        with pytest.raises(OSError):
+            writer.submit(fail)
+        writer.close()
+    assert done == list(range(5))
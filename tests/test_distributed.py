@@ -0,0 +1,71 @@
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from utils.distributed import GradientAllReduce, broadcast_object, close_distributed
+
+WORLD_SIZE = 2
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def flat_params(module):
+    return torch.cat([p.detach().reshape(-1) for p in module.parameters()])
+
+
+def train(rank, port, steps):
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+                            rank=rank, world_size=WORLD_SIZE)
+    try:
+        # Different initial weights and data on each process
+        torch.manual_seed(rank)
+        critic = torch.nn.Sequential(
+            torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.LeakyReLU(0.2), torch.nn.Linear(8, 1))
+        sync = GradientAllReduce(critic, WORLD_SIZE)
+        optimizer = torch.optim.Adam(critic.parameters(), lr=0.01)
+        for step in range(steps):
+            real, fake = torch.randn(6, 4) + 1, torch.randn(6, 4)
+            # Critic loss with the gradient penalty, a double backward
+            alpha = torch.rand(6, 1)
+            interpolates = (alpha * real + (1 - alpha) * fake).requires_grad_(True)
+            gradients, = torch.autograd.grad(critic(interpolates).sum(), interpolates, create_graph=True)
+            penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
+            loss = critic(fake).mean() - critic(real).mean() + 10 * penalty
+            optimizer.zero_grad()
+            loss.backward()
+            local = torch.cat([p.grad.reshape(-1) for p in critic.parameters()])
+            sync.sync()
+            averaged = torch.cat([p.grad.reshape(-1) for p in critic.parameters()])
+            gathered = [torch.empty_like(local) for _ in range(WORLD_SIZE)]
+            dist.all_gather(gathered, local)
+            assert torch.allclose(averaged, torch.stack(gathered).mean(0), atol=1e-6)
+            optimizer.step()
+            for tensor in [flat_params(critic), critic[1].running_mean, critic[1].running_var]:
+                gathered = [torch.empty_like(tensor) for _ in range(WORLD_SIZE)]
+                dist.all_gather(gathered, tensor)
+                assert all(torch.equal(g, gathered[0]) for g in gathered), step
+        assert broadcast_object('rank {}'.format(rank)) == 'rank 0'
+    finally:
+        close_distributed()
+    assert not dist.is_initialized()
+
+
+def test_parameters_stay_identical_across_processes():
+    mp.spawn(train, args=(free_port(), 4), nprocs=WORLD_SIZE)
+
+
+def test_single_process_does_nothing():
+    critic = torch.nn.Linear(3, 1)
+    critic(torch.randn(2, 3)).sum().backward()
+    grad = critic.weight.grad.clone()
+    GradientAllReduce(critic).sync()
+    assert torch.equal(critic.weight.grad, grad)
+    assert broadcast_object(3) == 3
+    close_distributed()
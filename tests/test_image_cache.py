@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+import torchvision
+
+from utils import image_cache
+from utils.fast_decode import open_image
+from tests.helpers import make_image_folder
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return make_image_folder(str(tmp_path / 'images'))
+
+
+def test_build_matches_decoded_images(folder):
+    dataset = image_cache.load_image_cache(folder, 8)
+    reference = torchvision.datasets.ImageFolder(folder)
+    assert len(dataset) == len(reference.samples) == 9
+    images, targets = dataset[list(range(len(dataset)))]
+    assert images.dtype == torch.uint8 and images.shape == (9, 3, 8, 8)
+    for i, (path, target) in enumerate(reference.samples):
+        with open(path, 'rb') as f:
+            expected = np.asarray(open_image(f, 8)).transpose(2, 0, 1)
+        assert np.array_equal(images[i].numpy(), expected)
+        assert targets[i] == target
+
+
+def test_reload_does_not_rebuild(folder, monkeypatch):
+    image_cache.load_image_cache(folder, 8)
+    array_path, index_path = image_cache.cache_paths(folder, 8)
+    assert os.path.isfile(array_path) and os.path.isfile(index_path)
+    assert not os.path.exists('{}.tmp.npy'.format(array_path[:-len('.npy')]))
+
+    def fail(*args):
+        raise AssertionError('cache rebuilt')
+    monkeypatch.setattr(image_cache, 'build_image_cache', fail)
+    dataset = image_cache.load_image_cache(folder, 8)
+    assert len(dataset) == 9
+    # Another size is another cache
+    with pytest.raises(AssertionError):
+        image_cache.load_image_cache(folder, 4)
+
+
+def test_batch_sampler_batches(folder):
+    dataset = image_cache.load_image_cache(folder, 8)
+    sampler = image_cache.batch_sampler(dataset, 4)
+    batches = list(sampler)
+    assert [len(b) for b in batches] == [4, 4, 1]
+    assert sorted(i for b in batches for i in b) == list(range(9))
+    assert len(list(image_cache.batch_sampler(dataset, 4, drop_last=True))) == 2
+
+    # The DataLoader hands whole batches of indices to the dataset
+    loader = torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=None)
+    images, targets = next(iter(loader))
+    assert images.shape == (4, 3, 8, 8) and targets.shape == (4,)
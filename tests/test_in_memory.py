@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+import torchvision
+
+from utils.in_memory import InMemoryLoader, load_in_memory
+
+
+class FakeData(object):
+    # Same attributes as torchvision's MNIST (N, H, W) and CIFAR10 (N, H, W, C)
+    def __init__(self, shape):
+        self.data = np.random.RandomState(0).randint(0, 256, shape, dtype=np.uint8)
+        self.targets = list(range(shape[0]))
+
+
+def test_load_in_memory_grayscale_and_rgb():
+    images, targets = load_in_memory(FakeData((10, 28, 28)), 16, chunk_size=3)
+    assert images.dtype == torch.uint8 and images.shape == (10, 1, 16, 16)
+    assert targets.tolist() == list(range(10))
+
+    data = FakeData((5, 32, 32, 3))
+    images, _ = load_in_memory(data, 16)
+    expected = torchvision.transforms.functional.resize(
+        torch.from_numpy(data.data).permute(0, 3, 1, 2), [16, 16], antialias=True)
+    assert images.shape == (5, 3, 16, 16)
+    assert torch.equal(images, expected)
+
+
+def make_loader(n_samples=10, **kwargs):
+    images = torch.arange(n_samples, dtype=torch.uint8).view(-1, 1, 1, 1)
+    return InMemoryLoader(images, torch.arange(n_samples), 4, **kwargs)
+
+
+def served(loader):
+    return [t for _, targets in loader for t in targets.tolist()]
+
+
+def test_batches_cover_dataset():
+    loader = make_loader()
+    assert len(loader) == 3
+    batches = list(loader)
+    assert [len(t) for _, t in batches] == [4, 4, 2]
+    for images, targets in batches:
+        assert images.view(-1).tolist() == targets.tolist()
+    assert sorted(served(loader)) == list(range(10))
+    assert len(make_loader(drop_last=True)) == len(list(make_loader(drop_last=True))) == 2
+    assert served(make_loader(shuffle=False)) == list(range(10))
+
+
+def test_distributed_ranks_share_permutation():
+    ranks = [make_loader(rank=r, world_size=2, seed=3) for r in range(2)]
+    epoch_0 = [served(loader) for loader in ranks]
+    assert [len(s) for s in epoch_0] == [5, 5]
+    assert sorted(epoch_0[0] + epoch_0[1]) == list(range(10))
+    # Same seed and epoch, same shares; a new epoch reshuffles them
+    assert served(make_loader(rank=0, world_size=2, seed=3)) == epoch_0[0]
+    for loader in ranks:
+        loader.set_epoch(1)
+    epoch_1 = [served(loader) for loader in ranks]
+    assert sorted(epoch_1[0] + epoch_1[1]) == list(range(10))
+    assert epoch_1 != epoch_0
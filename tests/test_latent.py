@@ -0,0 +1,50 @@
+import pytest
+import torch
+
+from utils.latent import LatentSampler
+
+
+@pytest.mark.parametrize('block_steps', [1, 4])
+def test_seeded_stream_is_reproducible(block_steps):
+    a = LatentSampler(3, 5, 'cpu', block_steps=block_steps, seed=7)
+    b = LatentSampler(3, 5, 'cpu', block_steps=block_steps, seed=7)
+    for _ in range(6):
+        x, y = a.sample(), b.sample()
+        assert x.shape == (5, 3)
+        assert torch.equal(x, y)
+    assert not torch.equal(a.sample(), LatentSampler(3, 5, 'cpu', block_steps=block_steps, seed=8).sample())
+
+
+def test_blocks_are_drawn_in_one_call():
+    # A block of noise is the same stream as the batches drawn one by one
+    blocked = LatentSampler(3, 5, 'cpu', block_steps=4, seed=0)
+    generator = torch.Generator().manual_seed(0)
+    expected = torch.empty(4, 5, 3).normal_(generator=generator)
+    for i in range(4):
+        assert torch.equal(blocked.sample(), expected[i])
+
+
+def test_single_step_batches_are_not_aliased():
+    latent = LatentSampler(3, 5, 'cpu', block_steps=1, seed=0)
+    first = latent.sample()
+    kept = first.clone()
+    latent.sample()
+    assert torch.equal(first, kept)
+
+
+def test_blocked_batches_are_views_until_the_block_is_used_up():
+    latent = LatentSampler(3, 5, 'cpu', block_steps=2, seed=0)
+    first = latent.sample()
+    kept = first.clone()
+    latent.sample()
+    assert torch.equal(first, kept)
+    latent.sample()
+    assert not torch.equal(first, kept)
+
+
+def test_other_sizes_and_uniform():
+    latent = LatentSampler(3, 5, 'cpu', block_steps=2, seed=0, distribution='uniform')
+    samples = latent.sample(11)
+    assert samples.shape == (11, 3)
+    assert samples.min() >= 0 and samples.max() < 1
+    assert latent.sample().shape == (5, 3)
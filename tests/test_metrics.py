@@ -0,0 +1,46 @@
+import torch
+import yaml
+
+from utils.metrics import MetricAccumulator, write_summary
+
+
+class Writer(object):
+    def __init__(self):
+        self.scalars = []
+
+    def add_scalar(self, tag, value, step):
+        self.scalars.append((tag, value, step))
+
+
+def test_values_reach_lists_and_writer_at_flush():
+    writer = Writer()
+    metrics = MetricAccumulator(writer, flush_every=3)
+    losses, epoch_losses = [], []
+    for i in range(4):
+        metrics.add(torch.tensor([float(i)]), (losses, epoch_losses), 'loss', i)
+        metrics.add(torch.tensor(i * 10.0, requires_grad=True), (), 'distance', i)
+        metrics.step()
+        if i < 2:
+            assert losses == [] and writer.scalars == []
+    assert losses == epoch_losses == [0.0, 1.0, 2.0]
+    metrics.flush()
+    assert losses == [0.0, 1.0, 2.0, 3.0]
+    assert writer.scalars == [
+        (tag, float(i) * scale, i) for i in range(4) for tag, scale in [('loss', 1), ('distance', 10)]]
+    # Nothing left to flush
+    metrics.flush()
+    assert len(writer.scalars) == 8
+
+
+def test_flush_without_writer_or_tag():
+    metrics = MetricAccumulator(flush_every=100)
+    values = []
+    metrics.add(torch.tensor(1.5), (values,))
+    metrics.flush()
+    assert values == [1.5]
+
+
+def test_write_summary(tmp_path):
+    write_summary('{}/'.format(tmp_path), {'distance': torch.tensor(0.25), 'loss': 2})
+    with open(tmp_path / 'summary.yml') as f:
+        assert yaml.safe_load(f) == {'distance': 0.25, 'loss': 2.0}
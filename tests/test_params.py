@@ -0,0 +1,43 @@
+import torch
+
+from utils.params import ParamGroup
+
+
+def model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 1))
+
+
+def test_clamp_matches_per_parameter_clamp():
+    module = model()
+    for p in module.parameters():
+        p.data.mul_(10)
+    expected = [p.detach().clamp(-0.01, 0.01) for p in module.parameters()]
+    ParamGroup(module).clamp_(-0.01, 0.01)
+    for p, e in zip(module.parameters(), expected):
+        assert torch.equal(p, e)
+        assert p.requires_grad
+
+
+def test_freeze_and_unfreeze():
+    module = model()
+    group = ParamGroup(module)
+    group.freeze()
+    assert not any(p.requires_grad for p in module.parameters())
+    assert module(torch.randn(3, 4)).grad_fn is None
+    group.unfreeze()
+    assert all(p.requires_grad for p in module.parameters())
+    module(torch.randn(3, 4)).sum().backward()
+    assert all(p.grad is not None for p in module.parameters())
+
+
+def test_requires_grad_skips_parameters_in_the_right_state():
+    module = model()
+    group = ParamGroup(module)
+    group.freeze()
+    # Changed behind the group's back, so the next freeze must be a no-op
+    next(module.parameters()).requires_grad_(True)
+    group.freeze()
+    assert next(module.parameters()).requires_grad
+    group.unfreeze()
+    assert all(p.requires_grad for p in module.parameters())
@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from utils.prefetch import InfiniteBatches
+
+
+def make_loader(n_samples, batch_size, drop_last=False):
+    dataset = torch.utils.data.TensorDataset(torch.arange(n_samples), torch.arange(n_samples) % 2)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, drop_last=drop_last)
+
+
+def test_fixed_batch_size_across_epochs():
+    batches = InfiniteBatches(make_loader(10, 4), 'cpu', 3)
+    try:
+        images = [next(batches)[0] for _ in range(10)]
+    finally:
+        batches.close()
+    assert all(b.shape == (3,) for b in images)
+    # Short batches are merged across epochs, in order and without dropping samples
+    assert torch.cat(images).tolist() == (list(range(10)) * 3)[:30]
+    assert batches.epochs >= 2
+
+
+def test_transform():
+    batches = InfiniteBatches(make_loader(8, 4), 'cpu', 4, transform=lambda x: x * 2)
+    try:
+        images, targets = next(batches)
+    finally:
+        batches.close()
+    assert images.tolist() == [0, 2, 4, 6]
+    assert targets.tolist() == [0, 1, 0, 1]
+
+
+def test_close_stops_thread():
+    batches = InfiniteBatches(make_loader(10, 4), 'cpu', 3, prefetch=1)
+    next(batches)
+    batches.close()
+    assert not batches.thread.is_alive()
+
+
+@pytest.mark.parametrize('n_samples, drop_last', [(0, False), (3, True)])
+def test_no_full_batch_raises(n_samples, drop_last):
+    batches = InfiniteBatches(make_loader(n_samples, 4, drop_last), 'cpu', 4)
+    try:
+        with pytest.raises(ValueError, match='no batch'):
+            next(batches)
+    finally:
+        batches.close()
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.render import Renderer, append_gif
+
+
+def frames(mode, n, size=(10, 7)):
+    rng = np.random.RandomState(0)
+    images = []
+    for _ in range(n):
+        if mode == 'L':
+            images.append(Image.fromarray(rng.randint(0, 256, size[::-1], dtype=np.uint8)))
+        else:
+            rgb = Image.fromarray(rng.randint(0, 256, size[::-1] + (3,), dtype=np.uint8))
+            images.append(rgb.quantize(64))
+    return images
+
+
+def read_gif(path):
+    with Image.open(path) as gif:
+        read = []
+        for i in range(gif.n_frames):
+            gif.seek(i)
+            read.append(gif.convert('RGB'))
+        return gif.size, read
+
+
+@pytest.mark.parametrize('mode', ['L', 'P'])
+def test_frames_round_trip(tmp_path, mode):
+    path = str(tmp_path / 'animation.gif')
+    images = frames(mode, 4)
+    for image in images:
+        append_gif(image, path, duration=0.2)
+    with Image.open(path) as gif:
+        assert gif.n_frames == 4
+        assert gif.size == (10, 7)
+        assert gif.info['duration'] == 200
+        assert gif.info['loop'] == 0
+    size, read = read_gif(path)
+    for image, frame in zip(images, read):
+        assert np.array_equal(np.asarray(frame), np.asarray(image.convert('RGB')))
+
+
+def test_resume_appends_after_a_restart(tmp_path):
+    path = str(tmp_path / 'animation.gif')
+    images = frames('L', 5)
+    for image in images[:3]:
+        append_gif(image, path)
+    # A new process continues the animation
+    renderer = Renderer(background=False)
+    renderer.start_gif(path, resume=True)
+    for image in images[3:]:
+        append_gif(image, renderer.gif_path)
+    size, read = read_gif(path)
+    assert len(read) == 5
+    for image, frame in zip(images, read):
+        assert np.array_equal(np.asarray(frame.convert('L')), np.asarray(image))
+    # Without resume the animation starts over
+    renderer.start_gif(path)
+    append_gif(images[0], path)
+    assert len(read_gif(path)[1]) == 1
+
+
+def test_frames_of_another_size_are_refused(tmp_path):
+    path = str(tmp_path / 'animation.gif')
+    append_gif(frames('L', 1)[0], path)
+    with pytest.raises(ValueError):
+        append_gif(frames('L', 1, size=(8, 7))[0], path)
+    with Image.open(path) as gif:
+        assert gif.n_frames == 1
+
+
+def read_png(path):
+    with Image.open(path) as image:
+        return np.asarray(image)
+
+
+@pytest.mark.parametrize('scale', [1, 2])
+@pytest.mark.parametrize('channels, n', [(3, 11), (1, 5)])
+def test_renderer_matches_make_grid(tmp_path, scale, channels, n):
+    import torch
+    import torchvision
+    torch.manual_seed(0)
+    images = torch.rand(n, channels, 6, 5) * 2 - 1
+    renderer = Renderer(scale=scale, background=False)
+    renderer.render_async(images, str(tmp_path / 'frame'))
+    renderer.close()
+    # The grid of the old matplotlib frames, before it was shown
+    expected = torchvision.utils.make_grid(images.add(1).mul(127.5).round().to(torch.uint8))
+    expected = expected.repeat_interleave(scale, 1).repeat_interleave(scale, 2)
+    expected = expected.permute(1, 2, 0).numpy()
+    grid = read_png(str(tmp_path / 'frame.png'))
+    if channels == 1:
+        # make_grid repeats single channels to RGB, the PNG is grayscale
+        expected = expected[:, :, 0]
+    assert grid.shape == expected.shape
+    assert np.array_equal(grid, expected)
+
+
+def test_background_renderer_writes_in_order(tmp_path):
+    import torch
+    renderer = Renderer(nrow=2, scale=2, max_in_flight=2)
+    renderer.start_gif(str(tmp_path / 'animation.gif'))
+    torch.manual_seed(0)
+    batches = [torch.rand(4, 3, 6, 6) * 2 - 1 for _ in range(5)]
+    for i, images in enumerate(batches):
+        renderer.render_async(images, str(tmp_path / 'frame_{}'.format(i)), caption='epoch {}'.format(i))
+    renderer.close()
+    size, read = read_gif(str(tmp_path / 'animation.gif'))
+    assert len(read) == 5
+    for i, frame in enumerate(read):
+        png = read_png(str(tmp_path / 'frame_{}.png'.format(i)))
+        assert size == (png.shape[1], png.shape[0])
+        # The caption bar is above the grid, which is quantized in the GIF
+        assert png.shape[0] > 2 * (2 * 6 + 3 * 2)
+        assert np.abs(np.asarray(frame).astype(int) - png).mean() < 8
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+import torch
+
+from utils import shards
+from tests.helpers import make_image_folder
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return make_image_folder(str(tmp_path / 'images'))
+
+
+def key(image):
+    return tuple(image.flatten()[:32].tolist())
+
+
+def epoch_orders(dataset, n_epochs, seed):
+    torch.manual_seed(seed)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2,
+                                         persistent_workers=True)
+    return [[key(image) for image, _ in loader] for _ in range(n_epochs)]
+
+
+def test_write_shards_even_split(folder):
+    out_dir = shards.write_shards(folder, shard_size=10000, min_shards=4)
+    with open('{}index.json'.format(out_dir), 'r') as f:
+        index = json.load(f)
+    assert [s['count'] for s in index['shards']] == [2, 2, 2, 3]
+    assert index['num_samples'] == 9
+    # At most shard_size images per shard, rounded up to a multiple of min_shards
+    out_dir = shards.write_shards(folder, shard_size=2, min_shards=2)
+    assert shards.num_shards(out_dir) == 6
+
+
+def test_load_shards_rewrites_for_more_readers(folder):
+    shards.load_shards(folder, 8)
+    assert shards.num_shards(shards.shard_dir(folder)) == 1
+    shards.load_shards(folder, 8, num_workers=3)
+    assert shards.num_shards(shards.shard_dir(folder)) == 3
+
+
+def test_split_across_ranks(folder):
+    shards.write_shards(folder, min_shards=4)
+    path = shards.shard_dir(folder)
+    ranks = [shards.ShardDataset(path, 8, rank=r, world_size=2) for r in range(2)]
+    samples = [[key(image) for image, _ in dataset] for dataset in ranks]
+    assert not set(samples[0]) & set(samples[1])
+    assert [len(s) for s in samples] == [d.num_samples for d in ranks]
+    assert sum(d.num_samples for d in ranks) == 9
+
+
+def test_split_across_workers(folder):
+    dataset = shards.load_shards(folder, 8, num_workers=2)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2)
+    samples = [key(image) for image, _ in loader]
+    assert len(samples) == len(set(samples)) == 9
+    images, targets = next(iter(torch.utils.data.DataLoader(dataset, batch_size=4)))
+    assert images.dtype == torch.uint8 and images.shape == (4, 3, 8, 8)
+
+
+def test_epoch_reshuffle(folder):
+    dataset = shards.load_shards(folder, 8, num_workers=2)
+    orders = epoch_orders(dataset, 3, seed=0)
+    assert all(sorted(order) == sorted(orders[0]) for order in orders)
+    # Persistent workers keep their seed, the order still changes every epoch
+    assert orders[0] != orders[1] and orders[1] != orders[2]
+    # and is the same in another run with the same seed
+    assert epoch_orders(dataset, 3, seed=0) == orders
+    assert epoch_orders(dataset, 3, seed=1) != orders
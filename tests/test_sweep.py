@@ -0,0 +1,64 @@
+import os
+
+import yaml
+
+from utils.sweep import expand, run_configs, summary_table, train
+
+
+def test_expand_grid_and_runs():
+    variants = expand({'grid': {'a': [1, 2], 'b': ['x', 'y']}, 'runs': [{'c': 0}, {'c': 1, 'a': 3}]})
+    assert len(variants) == 8
+    assert variants[:2] == [{'a': 1, 'b': 'x', 'c': 0}, {'a': 3, 'b': 'x', 'c': 1}]
+    assert {(v['a'], v['b']) for v in variants[::2]} == {(1, 'x'), (1, 'y'), (2, 'x'), (2, 'y')}
+
+
+def test_expand_grid_or_runs_alone():
+    assert expand({'grid': {'a': [1, 2]}}) == [{'a': 1}, {'a': 2}]
+    assert expand({'runs': [{'a': 1}]}) == [{'a': 1}]
+    assert expand({}) == [{}]
+
+
+def test_run_configs_share_the_cache():
+    base = {'dataset': 'CELEBA', 'batch_size': 64, 'num_workers': 4, 'result_dir': 'None'}
+    configs = run_configs(base, [{'batch_size': 32}, {'num_workers': 2}], 'sweep/', 3)
+    assert [c['batch_size'] for c in configs] == [32, 64]
+    assert [c['result_dir'] for c in configs] == ['sweep/run_00/', 'sweep/run_01/']
+    for config in configs:
+        assert config['data_format'] == 'cache'
+        assert config['threads_per_process'] == 3
+        assert not config['tune_threads'] and config['headless']
+    # Workers are dropped unless the variant sets them
+    assert [c['num_workers'] for c in configs] == [0, 2]
+    assert base['batch_size'] == 64 and 'data_format' not in base
+
+
+def test_run_configs_keep_other_datasets():
+    configs = run_configs({'dataset': 'MNIST', 'num_workers': 4}, [{}], 'sweep/', 1)
+    assert 'data_format' not in configs[0]
+    assert configs[0]['num_workers'] == 4
+
+
+def test_train_and_summary(tmp_path):
+    script = tmp_path / 'train.py'
+    script.write_text(
+        'import sys, yaml\n'
+        'config = yaml.safe_load(open(sys.argv[2]))\n'
+        'print(config["result_dir"])\n'
+        'open(config["result_dir"] + "summary.yml", "w").write("distance: 0.5\\n")\n'
+        'sys.exit(config["code"])\n')
+    variants = [{'code': 0}, {'code': 3}]
+    configs = run_configs({'dataset': 'MNIST'}, variants, 'sweep/', 1)
+    return_codes = []
+    for i, config in enumerate(configs):
+        os.makedirs(tmp_path / config['result_dir'])
+        config_path = str(tmp_path / 'run_{:02d}.yml'.format(i))
+        with open(config_path, 'w') as f:
+            yaml.dump(config, f)
+        return_codes.append(train(str(script), config_path, config_path[:-4] + '.log', 1))
+        with open(config_path[:-4] + '.log') as f:
+            assert f.read().strip() == config['result_dir']
+    assert return_codes == [0, 3]
+    columns, rows = summary_table(configs, variants, return_codes, str(tmp_path))
+    assert columns == ['run', 'code', 'status', 'distance']
+    assert [row['status'] for row in rows] == ['ok', 'failed (3)']
+    assert [row['distance'] for row in rows] == [0.5, 0.5]
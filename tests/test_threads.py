@@ -0,0 +1,50 @@
+import torch
+
+from utils.threads import model_step_times, record_config, tune_threads
+
+
+def models():
+    torch.manual_seed(0)
+    discriminator = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 4, 3), torch.nn.BatchNorm2d(4), torch.nn.Flatten(), torch.nn.Linear(4 * 6 * 6, 1))
+    generator = torch.nn.Sequential(torch.nn.Linear(5, 3 * 8 * 8), torch.nn.Unflatten(1, (3, 8, 8)))
+    return discriminator, generator
+
+
+def test_critic_steps_use_the_given_loss():
+    discriminator, generator = models()
+    calls = []
+
+    def critic_loss(real, fake, penalty_step):
+        calls.append(penalty_step)
+        assert real.shape == fake.shape == (4, 3, 8, 8)
+        return torch.mean(discriminator(fake) - discriminator(real))
+
+    critic_time, generator_time = model_step_times(
+        discriminator, generator, 5, 4, (3, 8, 8), 'cpu', critic_loss=critic_loss, penalty_every=4, n_steps=2)
+    assert critic_time > 0 and generator_time > 0
+    # Warm up and timed steps, with and without the penalty
+    assert calls == [True] * 3 + [False] * 3
+    assert all(p.requires_grad for p in discriminator.parameters())
+
+    calls.clear()
+    model_step_times(discriminator, generator, 5, 4, (3, 8, 8), 'cpu', critic_loss=critic_loss, n_steps=2)
+    assert calls == [True] * 3
+
+
+def test_tune_threads_leaves_the_models_as_they_were():
+    discriminator, generator = models()
+    states = [{k: v.clone() for k, v in m.state_dict().items()} for m in (discriminator, generator)]
+    threads, workers = tune_threads(discriminator, generator, 5, 4, (3, 8, 8), 'cpu', n_steps=1, verbose=False)
+    assert threads >= 1 and workers == 0
+    assert torch.get_num_threads() == threads
+    for m, state in zip((discriminator, generator), states):
+        assert all(torch.equal(v, state[k]) for k, v in m.state_dict().items())
+        assert all(p.grad is None for p in m.parameters())
+
+
+def test_record_config_keeps_the_other_lines(tmp_path):
+    path = tmp_path / 'config.yml'
+    path.write_bytes(b'# Threads\r\nthreads_per_process: auto\r\nbatch_size: 64')
+    record_config(str(path), {'threads_per_process': 4, 'num_workers': 2})
+    assert path.read_bytes() == b'# Threads\r\nthreads_per_process: 4\r\nbatch_size: 64\r\nnum_workers: 2'
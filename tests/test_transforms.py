@@ -0,0 +1,34 @@
+import torch
+import torchvision
+
+from utils.transforms import BatchTransform
+
+
+def batch():
+    return torch.randint(0, 256, (6, 3, 5, 7), dtype=torch.uint8, generator=torch.Generator().manual_seed(0))
+
+
+def test_matches_to_tensor_and_normalize():
+    images = batch()
+    normalize = torchvision.transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+    # ToTensor scales uint8 images to [0, 1]
+    expected = torch.stack([normalize(image.float() / 255) for image in images])
+    output = BatchTransform()(images)
+    assert output.dtype == torch.float32
+    assert torch.allclose(output, expected, atol=1e-6)
+    assert output.min() >= -1 and output.max() <= 1
+
+
+def test_hflip_flips_whole_images():
+    images = batch()
+    torch.manual_seed(0)
+    output = BatchTransform(hflip=True)(images)
+    plain = BatchTransform()(images)
+    flipped = [torch.equal(o, p.flip(2)) for o, p in zip(output, plain)]
+    assert all(torch.equal(o, p) or f for o, p, f in zip(output, plain, flipped))
+    assert 0 < sum(flipped) < len(images)
+
+
+def test_channels_last():
+    output = BatchTransform(channels_last=True)(batch())
+    assert output.is_contiguous(memory_format=torch.channels_last)
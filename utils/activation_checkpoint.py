@@ -0,0 +1,77 @@
+import functools
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+CONV_LAYERS = (nn.Conv2d, nn.ConvTranspose2d)
+
+
+def conv_segments(block):
+    # Splits an nn.Sequential in segments that start at each convolution, so
+    # the in-place activations stay inside the segment that created them
+    starts = [0] + [i for i, layer in enumerate(block) if isinstance(layer, CONV_LAYERS) and i > 0]
+    return [nn.Sequential(*list(block)[start:end])
+            for start, end in zip(starts, starts[1:] + [len(block)])]
+
+
+class _Segment(object):
+    # Runs a segment for one checkpoint. The second call is the recomputation
+    # during backward: BatchNorm must normalize the same way as in the first
+    # call, split batches included, without updating its running stats again
+    def __init__(self, layers):
+        self.layers = layers
+        self.norms = [m for m in layers.modules() if isinstance(m, nn.BatchNorm2d)]
+        self.split_sizes = None
+
+    def __call__(self, x):
+        if self.split_sizes is None:
+            self.split_sizes = [getattr(m, 'split_sizes', None) for m in self.norms]
+            return self.layers(x)
+        # momentum 0 keeps the running stats, num_batches_tracked is restored
+        saved = [(m.momentum, m.num_batches_tracked.clone(), getattr(m, 'split_sizes', None))
+                 for m in self.norms]
+        for m, split_sizes in zip(self.norms, self.split_sizes):
+            m.momentum = 0.
+            if split_sizes is not None:
+                m.split_sizes = split_sizes
+        try:
+            return self.layers(x)
+        finally:
+            for m, (momentum, num_batches_tracked, split_sizes) in zip(self.norms, saved):
+                m.momentum = momentum
+                m.num_batches_tracked.copy_(num_batches_tracked)
+                if hasattr(m, 'split_sizes'):
+                    m.split_sizes = split_sizes
+
+
+def _checkpointed_forward(plan, x):
+    for layers, recompute in plan:
+        if recompute and torch.is_grad_enabled():
+            x = checkpoint(_Segment(layers), x, use_reentrant=False)
+        else:
+            x = layers(x)
+    return x
+
+
+def checkpoint_segments(model, selected):
+    # Activation checkpointing for the selected segments ('all' or a list of
+    # indices), numbered in order across the nn.Sequential blocks of the
+    # model. Consecutive selected segments are checkpointed as one region:
+    # only its input is kept for backward, everything inside is recomputed.
+    # Works with double backward. Modules and state_dict are unchanged.
+    index = 0
+    for block in model.children():
+        if not isinstance(block, nn.Sequential):
+            continue
+        plan = []
+        for layers in conv_segments(block):
+            recompute = selected == 'all' or index in selected
+            if plan and plan[-1][1] == recompute:
+                plan[-1] = (nn.Sequential(*plan[-1][0], *layers), recompute)
+            else:
+                plan.append((layers, recompute))
+            index += 1
+        if any(recompute for _, recompute in plan):
+            block.forward = functools.partial(_checkpointed_forward, plan)
+    return index
@@ -0,0 +1,32 @@
+import torch
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class MixedPrecision(object):
+    # Autocast and loss scaling for the precision set in config.yml. Only
+    # fp16 needs loss scaling, bf16 has the same exponent range as fp32.
+    def __init__(self, precision, device):
+        self.device_type = torch.device(device).type
+        self.dtype = PRECISIONS[precision]
+        self.enabled = self.dtype is not None
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def wrap(self, model):
+        # Runs the forward pass of the model under autocast and returns fp32
+        # outputs, so losses, gradient penalty and plots stay in fp32
+        if not self.enabled:
+            return model
+        forward = model.forward
+
+        def autocast_forward(*args, **kwargs):
+            with self.autocast():
+                return forward(*args, **kwargs).float()
+        model.forward = autocast_forward
+        return model
+
+    def scaler(self):
+        # Disabled scalers pass losses and optimizer steps through unchanged
+        return torch.amp.GradScaler(self.device_type, enabled=self.dtype == torch.float16)
@@ -0,0 +1,88 @@
+import os
+import time
+import queue
+import shutil
+import threading
+import contextlib
+
+import torch
+
+
+def snapshot(module):
+    # Copy of the state dict in CPU memory, which training can keep updating
+    # while the copy is written
+    return {k: v.detach().to('cpu', copy=True) for k, v in module.state_dict().items()}
+
+
+def atomic_save(obj, path):
+    tmp_path = '{}.tmp'.format(path)
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def atomic_dir(path):
+    # Yields a temporary directory that replaces path once everything has been
+    # written in it, so that path is either complete or missing
+    path = os.path.normpath(path)
+    tmp_path = '{}.tmp'.format(path)
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    yield os.path.join(tmp_path, '')
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter(object):
+    # Runs write jobs (checkpoints, frames) in order in a background thread.
+    # With max_in_flight jobs submitted and not written yet, submit() waits
+    # for the oldest one: a slow disk slows training down instead of piling
+    # up snapshots in memory. Without background the jobs run in submit().
+    # An error in a job is raised by the next submit() or by close().
+    def __init__(self, background=True, max_in_flight=2):
+        self.background = background
+        self.wait_time = 0.
+        self.error = None
+        if background:
+            self.slots = threading.Semaphore(max_in_flight)
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.slots.release()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args):
+        self._raise()
+        if not self.background:
+            fn(*args)
+            return
+        start = time.perf_counter()
+        self.slots.acquire()
+        self.wait_time += time.perf_counter() - start
+        self.queue.put((fn, args))
+
+    def close(self):
+        # Waits for the jobs left
+        if self.background:
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
@@ -0,0 +1,88 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+# Launched with several local processes, one per socket or group of cores:
+#   torchrun --standalone --nproc_per_node=4 wgan_gp.py
+
+
+def local_world_size():
+    # Number of processes started by torchrun on this machine
+    return int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+
+def init_distributed(backend='gloo'):
+    # Sets up the process group when launched by torchrun with more than one
+    # process. Returns (rank, world_size), (0, 1) for a single process.
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    dist.init_process_group(backend)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    return dist.get_rank(), world_size
+
+
+def close_distributed():
+    # Destroys the process group, to be called by every process before it
+    # exits, errors included
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def broadcast_object(obj):
+    # Value of obj on rank 0, for all the processes
+    if not dist.is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def set_epoch(loader, epoch):
+    # Samplers that split the data between processes draw a new permutation
+    # for each epoch, the same on every process
+    sampler = getattr(loader, 'sampler', None)
+    for obj in (loader, sampler, getattr(sampler, 'sampler', None)):
+        if hasattr(obj, 'set_epoch'):
+            obj.set_epoch(epoch)
+
+
+def _flat_copy(tensors, flat):
+    for t, f in zip(tensors, flat.split([t.numel() for t in tensors])):
+        t.copy_(f.view(t.shape))
+
+
+class GradientAllReduce(object):
+    # Data parallelism for a module: the parameters start from those of rank 0
+    # and sync() averages the gradients over the processes with a single
+    # all_reduce of the flattened gradients, after backward and before the
+    # optimizer step. Like DistributedDataParallel, the floating point
+    # buffers (BatchNorm running stats) are replaced with those of rank 0.
+    # Unlike it, it works with the double backward of the gradient penalty,
+    # reduces once per step with micro-batches and allows parameters to be
+    # frozen between steps. Nothing is done with a single process.
+    def __init__(self, module, world_size=1):
+        self.params = list(module.parameters())
+        self.buffers = [b for b in module.buffers() if b.is_floating_point()]
+        self.world_size = world_size
+        if world_size > 1:
+            with torch.no_grad():
+                for t in self.params + list(module.buffers()):
+                    dist.broadcast(t, src=0)
+
+    @torch.no_grad()
+    def sync(self):
+        if self.world_size == 1:
+            return
+        # The same parameters have gradients on every process
+        grads = [p.grad for p in self.params if p.grad is not None]
+        if grads:
+            flat = torch.cat([g.reshape(-1) for g in grads])
+            dist.all_reduce(flat)
+            _flat_copy(grads, flat.div_(self.world_size))
+        if self.buffers:
+            flat = torch.cat([b.reshape(-1) for b in self.buffers])
+            dist.broadcast(flat, src=0)
+            _flat_copy(self.buffers, flat)
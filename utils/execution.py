@@ -0,0 +1,20 @@
+import contextlib
+
+import torch
+
+
+def prepare_model(model, channels_last=False, compile=False):
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if compile:
+        # Compiles the module in place, parameters and state_dict are the same
+        model.compile()
+    return model
+
+
+def eager(compiled=True):
+    # Compiled modules run eagerly inside this context. Needed for the
+    # gradient penalty, compiled graphs do not support double backward.
+    if not compiled:
+        return contextlib.nullcontext()
+    return torch.compiler.set_stance('force_eager')
@@ -0,0 +1,23 @@
+from PIL import Image
+
+
+def open_image(f, image_size, fast_decode=False):
+    img = Image.open(f)
+    if fast_decode:
+        # For JPEGs, let the decoder downscale in the DCT domain by 1/2, 1/4
+        # or 1/8 while staying at least image_size; no-op for other formats
+        img.draft('RGB', (image_size, image_size))
+    img = img.convert('RGB')
+    # Same resampling as torchvision.transforms.Resize on PIL images
+    return img.resize((image_size, image_size), Image.BILINEAR)
+
+
+class DraftLoader(object):
+    # Image loader for torchvision.datasets.ImageFolder, a class instead of a
+    # closure so that it can be pickled into the DataLoader workers
+    def __init__(self, image_size):
+        self.image_size = image_size
+
+    def __call__(self, path):
+        with open(path, 'rb') as f:
+            return open_image(f, self.image_size, fast_decode=True)
@@ -0,0 +1,29 @@
+import contextlib
+
+import torch
+from torch import nn
+
+
+class SplitBatchNorm2d(nn.BatchNorm2d):
+    # BatchNorm2d that, inside split_batches, normalizes consecutive chunks of
+    # the batch with their own statistics. Running statistics are updated
+    # once per chunk, in order, exactly as with separate forward passes.
+    split_sizes = None
+
+    def forward(self, x):
+        if self.split_sizes is None or not self.training:
+            return super(SplitBatchNorm2d, self).forward(x)
+        return torch.cat([super(SplitBatchNorm2d, self).forward(chunk)
+                          for chunk in x.split(self.split_sizes)])
+
+
+@contextlib.contextmanager
+def split_batches(module, split_sizes):
+    layers = [m for m in module.modules() if isinstance(m, SplitBatchNorm2d)]
+    for m in layers:
+        m.split_sizes = split_sizes
+    try:
+        yield
+    finally:
+        for m in layers:
+            m.split_sizes = None
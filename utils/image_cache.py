@@ -0,0 +1,122 @@
+import os
+import json
+import argparse
+import contextlib
+
+import numpy as np
+import torch
+import torchvision
+
+from utils.fast_decode import open_image
+
+
+def cache_paths(image_folder, image_size):
+    prefix = '{}_{}px'.format(os.path.normpath(image_folder), image_size)
+    return '{}.npy'.format(prefix), '{}_index.json'.format(prefix)
+
+
+def build_image_cache(image_folder, image_size):
+    array_path, index_path = cache_paths(image_folder, image_size)
+    # ImageFolder only scans the folder here, images are decoded below
+    folder = torchvision.datasets.ImageFolder(root=image_folder)
+    print('Caching {} images from {} at {}x{}'.format(
+        len(folder.samples), image_folder, image_size, image_size))
+    # Write to a temporary file so that an interrupted run leaves no cache
+    tmp_path = '{}.tmp.npy'.format(array_path[:-len('.npy')])
+    images = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.uint8,
+        shape=(len(folder.samples), 3, image_size, image_size))
+    for i, (path, _) in enumerate(folder.samples):
+        # Built once, so images are always fully decoded before resizing
+        with open(path, 'rb') as f:
+            img = open_image(f, image_size)
+        images[i] = np.asarray(img).transpose(2, 0, 1)
+        if (i + 1) % 10000 == 0:
+            print('{}/{}'.format(i + 1, len(folder.samples)))
+    images.flush()
+    del images
+    os.replace(tmp_path, array_path)
+
+    index = {
+        'root': image_folder,
+        'image_size': image_size,
+        'classes': folder.classes,
+        'samples': [[os.path.relpath(path, image_folder), target]
+                    for path, target in folder.samples],
+    }
+    with open('{}.tmp'.format(index_path), 'w') as f:
+        json.dump(index, f)
+    os.replace('{}.tmp'.format(index_path), index_path)
+    return array_path, index_path
+
+
+@contextlib.contextmanager
+def cache_lock(array_path):
+    # Exclusive lock on a file next to the cache, without locking where
+    # fcntl is not available
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open('{}.lock'.format(array_path), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ImageCacheDataset(torch.utils.data.Dataset):
+    # Indexed with a whole batch of indices at a time (see batch_sampler)
+    def __init__(self, array_path, index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        self.array_path = array_path
+        self.targets = torch.tensor([target for _, target in index['samples']])
+        # Opened lazily so that the memmap is not pickled into the workers
+        self.images = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, indices):
+        if self.images is None:
+            self.images = np.load(self.array_path, mmap_mode='r')
+        # Sorted indices turn the batch into mostly sequential reads
+        indices = np.sort(np.asarray(indices))
+        # Batches stay uint8, they are normalized by utils.transforms
+        images = torch.from_numpy(self.images[indices])
+        return images, self.targets[indices]
+
+
+def batch_sampler(dataset, batch_size, drop_last=False, distributed=False):
+    # A distributed run gives each process its own share of every epoch
+    if distributed:
+        sampler = torch.utils.data.DistributedSampler(dataset)
+    else:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    return torch.utils.data.BatchSampler(
+        sampler,
+        batch_size=batch_size,
+        drop_last=drop_last
+    )
+
+
+def load_image_cache(image_folder, image_size):
+    array_path, index_path = cache_paths(image_folder, image_size)
+    if not os.path.isfile(array_path) or not os.path.isfile(index_path):
+        # Runs started together build the cache once, the others wait for it
+        with cache_lock(array_path):
+            if not os.path.isfile(array_path) or not os.path.isfile(index_path):
+                build_image_cache(image_folder, image_size)
+    return ImageCacheDataset(array_path, index_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_folder', type=str, required=True)
+    parser.add_argument('--image_size', type=int, default=64)
+    args = parser.parse_args()
+
+    build_image_cache(args.image_folder, args.image_size)
@@ -0,0 +1,65 @@
+import math
+
+import numpy as np
+import torch
+import torchvision
+
+
+def load_in_memory(data, image_size, chunk_size=4096):
+    # data is a torchvision MNIST or CIFAR10 dataset, whose images are
+    # already loaded in memory as (N, H, W) or (N, H, W, C) uint8 arrays
+    images = torch.as_tensor(np.asarray(data.data))
+    if images.dim() == 3:
+        images = images.unsqueeze(1)
+    else:
+        images = images.permute(0, 3, 1, 2)
+    resized = torch.empty(
+        (images.shape[0], images.shape[1], image_size, image_size), dtype=torch.uint8)
+    # Resize in chunks to bound the memory used by the intermediate floats
+    for start in range(0, images.shape[0], chunk_size):
+        resized[start:start + chunk_size] = torchvision.transforms.functional.resize(
+            images[start:start + chunk_size], [image_size, image_size], antialias=True)
+    return resized, torch.as_tensor(data.targets)
+
+
+class InMemoryLoader(object):
+    # Serves shuffled batches by slicing a random permutation of the whole
+    # dataset, which lives in a single tensor on the training device. In a
+    # distributed run every process draws the same permutation, seeded with
+    # seed + epoch, and serves its own share of it.
+    def __init__(self, images, targets, batch_size, shuffle=True,
+                 drop_last=False, device='cpu', rank=0, world_size=1, seed=0):
+        self.images = images.to(device)
+        self.targets = targets.to(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = len(self.images) // world_size
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        device = self.images.device
+        if self.shuffle and self.world_size > 1:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.images), generator=generator, device=device)
+        elif self.shuffle:
+            order = torch.randperm(len(self.images), device=device)
+        else:
+            order = torch.arange(len(self.images), device=device)
+        if self.world_size > 1:
+            order = order[self.rank::self.world_size][:self.num_samples]
+        for i in range(len(self)):
+            idx = order[i * self.batch_size:(i + 1) * self.batch_size]
+            yield self.images[idx], self.targets[idx]
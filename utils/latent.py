@@ -0,0 +1,42 @@
+import torch
+
+
+class LatentSampler(object):
+    # Latent noise drawn directly on the device from a seeded torch.Generator.
+    # With block_steps > 1, noise for block_steps batches is drawn with a
+    # single call into a preallocated buffer and then handed out one batch at
+    # a time: the batches are views of that buffer, overwritten block_steps
+    # calls later, so a batch kept longer than that must be cloned. With
+    # block_steps = 1 every batch is a new tensor.
+    def __init__(self, n_features, batch_size, device, block_steps=1, seed='auto',
+                 distribution='normal'):
+        self.n_features = n_features
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.distribution = distribution
+        self.generator = torch.Generator(device=self.device)
+        if seed == 'auto' or seed is None:
+            self.seed = self.generator.seed()
+        else:
+            self.seed = int(seed)
+            self.generator.manual_seed(self.seed)
+        self.buffer = None
+        if block_steps > 1:
+            self.buffer = torch.empty(block_steps, batch_size, n_features, device=self.device)
+        self.position = block_steps
+
+    def _fill(self, tensor):
+        if self.distribution == 'uniform':
+            return tensor.uniform_(generator=self.generator)
+        return tensor.normal_(generator=self.generator)
+
+    def sample(self, n_samples=None):
+        if self.buffer is None or (n_samples is not None and n_samples != self.batch_size):
+            return self._fill(torch.empty(n_samples or self.batch_size, self.n_features,
+                                          device=self.device))
+        if self.position == self.buffer.shape[0]:
+            self._fill(self.buffer)
+            self.position = 0
+        noise = self.buffer[self.position]
+        self.position += 1
+        return noise
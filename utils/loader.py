@@ -0,0 +1,77 @@
+import os
+import math
+import time
+
+import torch
+
+from utils.distributed import local_world_size
+
+
+def dataloader_options(config, device):
+    num_workers = config.get('num_workers', 'auto')
+    if num_workers == 'auto':
+        # Keep one core for the training loop, the cores are shared by the
+        # processes of a distributed run
+        num_workers = max(0, min(8, (os.cpu_count() or 1) // local_world_size() - 1))
+    pin_memory = config.get('pin_memory', 'auto')
+    if pin_memory == 'auto':
+        pin_memory = device == 'cuda'
+    options = {
+        'num_workers': num_workers,
+        'pin_memory': pin_memory,
+        'drop_last': config.get('drop_last', False)
+    }
+    # These two are only accepted by the DataLoader when workers are used
+    if num_workers > 0:
+        options['persistent_workers'] = config.get('persistent_workers', True)
+        prefetch_factor = config.get('prefetch_factor', 'auto')
+        if prefetch_factor == 'auto':
+            prefetch_factor = 2
+        options['prefetch_factor'] = prefetch_factor
+    return options
+
+
+def with_options(loader, options):
+    # DataLoader over the same dataset, sampler and batches as loader, with
+    # other worker and pinning options (drop_last is kept from loader)
+    options = {k: v for k, v in options.items() if k != 'drop_last'}
+    kwargs = {'batch_size': loader.batch_size, 'drop_last': loader.drop_last,
+              'collate_fn': loader.collate_fn}
+    if not isinstance(loader.dataset, torch.utils.data.IterableDataset):
+        kwargs['sampler'] = loader.sampler
+    return torch.utils.data.DataLoader(loader.dataset, **kwargs, **options)
+
+
+def num_batches(loader, batch_size):
+    # Batches of batch_size in a pass over loader. Iterable datasets (shards)
+    # have no length, their number of samples is used instead
+    dataset = getattr(loader, 'dataset', None)
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        return math.ceil(dataset.num_samples / batch_size)
+    return len(loader)
+
+
+class TimedLoader(object):
+    # Wraps a DataLoader and measures the time spent waiting for batches
+    def __init__(self, loader):
+        self.loader = loader
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.wait_time += time.perf_counter() - start
+            yield batch
+
+    def reset(self):
+        wait_time = self.wait_time
+        self.wait_time = 0.
+        return wait_time
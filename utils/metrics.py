@@ -0,0 +1,47 @@
+import torch
+import torch.distributed as dist
+import yaml
+
+
+class MetricAccumulator(object):
+    # Per-step scalars stay on the device until flush(), which copies them to
+    # the host in a single transfer and appends them, in order, to their
+    # lists and to the SummaryWriter at the step they were recorded. With
+    # all_reduce the values are averaged over the processes at each flush.
+    def __init__(self, writer=None, flush_every=100, all_reduce=False):
+        self.writer = writer
+        self.flush_every = flush_every
+        self.all_reduce = all_reduce
+        self.n_steps = 0
+        self.values, self.targets = [], []
+
+    def add(self, value, lists=(), tag=None, step=None):
+        self.values.append(value.detach().float().reshape(()))
+        self.targets.append((lists, tag, step))
+
+    def step(self):
+        self.n_steps += 1
+        if self.n_steps % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if not self.values:
+            return
+        values = torch.stack(self.values)
+        if self.all_reduce:
+            dist.all_reduce(values)
+            values /= dist.get_world_size()
+        values = values.tolist()
+        for value, (lists, tag, step) in zip(values, self.targets):
+            for l in lists:
+                l.append(value)
+            if tag is not None and self.writer is not None:
+                self.writer.add_scalar(tag, value, step)
+        self.values, self.targets = [], []
+
+
+def write_summary(result_dir, values):
+    # Final metrics of a run in result_dir/summary.yml, read by utils.sweep
+    values = {key: float(value) for key, value in values.items()}
+    with open('{}summary.yml'.format(result_dir), 'w') as f:
+        yaml.dump(values, f, default_flow_style=False, sort_keys=False)
@@ -0,0 +1,29 @@
+import torch
+
+
+class ParamGroup(object):
+    # The parameters of a module, clipped with multi-tensor (foreach) kernels
+    # and frozen or unfrozen with one call
+    def __init__(self, module):
+        self.params = list(module.parameters())
+        self.requires_grad = all(p.requires_grad for p in self.params)
+
+    @torch.no_grad()
+    def clamp_(self, min_value, max_value):
+        # Two calls for all the parameters on every device: on CPU the
+        # foreach ops loop over the tensors in C++, not in Python
+        torch._foreach_clamp_min_(self.params, min_value)
+        torch._foreach_clamp_max_(self.params, max_value)
+
+    def requires_grad_(self, requires_grad=True):
+        # Nothing to do when the parameters are already in the right state
+        if requires_grad != self.requires_grad:
+            for p in self.params:
+                p.requires_grad_(requires_grad)
+            self.requires_grad = requires_grad
+
+    def freeze(self):
+        self.requires_grad_(False)
+
+    def unfreeze(self):
+        self.requires_grad_(True)
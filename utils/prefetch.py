@@ -0,0 +1,110 @@
+import time
+import queue
+import threading
+
+import torch
+
+from utils.distributed import set_epoch
+
+
+class InfiniteBatches(object):
+    # Endless source of fixed-size batches: a background thread iterates the
+    # loader epoch after epoch, moves the batches to the device and applies
+    # the transform while the training loop is busy with the previous ones
+    def __init__(self, loader, device, batch_size, prefetch=2, transform=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.transform = transform
+        self.wait_time = 0.
+        self.epochs = 0
+        self.stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _batches(self):
+        # Short batches are merged with the following ones, so that every
+        # batch has batch_size samples and no sample is dropped
+        images_left, targets_left = None, None
+        while not self.stopped.is_set():
+            set_epoch(self.loader, self.epochs)
+            n_batches = 0
+            for images, targets in self.loader:
+                if images_left is not None:
+                    images = torch.cat([images_left, images])
+                    targets = torch.cat([targets_left, targets])
+                    images_left, targets_left = None, None
+                while images.shape[0] >= self.batch_size:
+                    n_batches += 1
+                    yield images[:self.batch_size], targets[:self.batch_size]
+                    images = images[self.batch_size:]
+                    targets = targets[self.batch_size:]
+                if images.shape[0] > 0:
+                    images_left, targets_left = images, targets
+                if self.stopped.is_set():
+                    return
+            if n_batches == 0:
+                # Otherwise the loader would be iterated forever without a
+                # batch for the training loop
+                raise ValueError('A pass over the loader gave no batch of {} samples, the '
+                                 'dataset is empty or smaller than the batch size'.format(
+                                     self.batch_size))
+            self.epochs += 1
+
+    def _run(self):
+        try:
+            for images, targets in self._batches():
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        images, targets = self._to_device(images, targets)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    images, targets = self._to_device(images, targets)
+                self._put((images, targets, event))
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _to_device(self, images, targets):
+        images = images.to(self.device, non_blocking=True)
+        targets = targets.to(self.device, non_blocking=True)
+        if self.transform is not None:
+            images = self.transform(images)
+        return images, targets
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.wait_time += time.perf_counter() - start
+        if isinstance(item, Exception):
+            raise item
+        images, targets, event = item
+        if event is not None:
+            torch.cuda.current_stream().wait_event(event)
+            images.record_stream(torch.cuda.current_stream())
+            targets.record_stream(torch.cuda.current_stream())
+        return images, targets
+
+    def close(self):
+        # Stops the background thread, so the loader can be iterated again
+        self.stopped.set()
+        self.thread.join()
+
+    def reset(self):
+        wait_time = self.wait_time
+        self.wait_time = 0.
+        return wait_time
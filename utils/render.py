@@ -0,0 +1,163 @@
+import io
+import os
+import struct
+import threading
+import collections
+import multiprocessing
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Height of the caption bar above the grid, enough for the default PIL font
+CAPTION_HEIGHT = 16
+# Looping animation, the NETSCAPE2.0 application extension
+GIF_LOOP = b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+GIF_TRAILER = b'\x3b'
+
+
+def to_uint8(images):
+    # Generated images in [-1, 1] to uint8, on their device: the copy to the
+    # host is a quarter of the float one
+    import torch
+    return images.detach().add(1).mul_(127.5).round_().clamp_(0, 255).to(torch.uint8)
+
+
+def make_grid(images, nrow=8, padding=2):
+    # numpy version of torchvision.utils.make_grid for uint8 images of shape
+    # (N, C, H, W), returns a (H, W, C) array
+    n, c, h, w = images.shape
+    ncol = min(nrow, n)
+    nrows = (n + ncol - 1) // ncol
+    grid = np.zeros((nrows * (h + padding) + padding, ncol * (w + padding) + padding, c), np.uint8)
+    for i in range(n):
+        y = (i // ncol) * (h + padding) + padding
+        x = (i % ncol) * (w + padding) + padding
+        grid[y:y + h, x:x + w] = images[i].transpose(1, 2, 0)
+    return grid
+
+
+def gif_frame(image, duration):
+    # Encodes image alone with PIL and returns it as a GIF frame block: a
+    # graphic control extension with the duration, the image descriptor, its
+    # own color table (the global one of the single frame GIF) and the data
+    if image.mode not in ['L', 'P']:
+        image = image.quantize(256)
+    buffer = io.BytesIO()
+    image.save(buffer, 'GIF')
+    data = buffer.getvalue()
+    flags, pos, table = data[10], 13, b''
+    if flags & 0x80:
+        table = data[pos:pos + 3 * 2 ** ((flags & 7) + 1)]
+        pos += len(table)
+    while data[pos] == 0x21:
+        # Extensions of PIL, replaced by ours
+        pos += 2
+        while data[pos]:
+            pos += data[pos] + 1
+        pos += 1
+    descriptor = bytearray(data[pos:pos + 10])
+    if descriptor[9] & 0x80:
+        # PIL already wrote a local color table
+        table = b''
+    elif table:
+        descriptor[9] = 0x80 | (descriptor[9] & 0x40) | (flags & 7)
+    control = b'\x21\xf9\x04\x04' + struct.pack('<H', int(round(duration * 100))) + b'\x00\x00'
+    return control + bytes(descriptor) + table + data[pos + 10:-1]
+
+
+def append_gif(image, path, duration=0.5):
+    # Appends image to the animated GIF at path, created if missing: the new
+    # frame overwrites the trailer, so only this frame is encoded and the
+    # previous ones are never read back
+    frame = gif_frame(image, duration)
+    if not os.path.isfile(path):
+        with open(path, 'wb') as f:
+            f.write(b'GIF89a' + struct.pack('<HHBBB', image.width, image.height, 0, 0, 0))
+            f.write(GIF_LOOP + frame + GIF_TRAILER)
+        return
+    with open(path, 'r+b') as f:
+        width, height = struct.unpack('<HH', f.read(10)[6:])
+        if (width, height) != image.size:
+            raise ValueError('Frame of size {} does not fit the {}x{} animation {}'.format(
+                image.size, width, height, path))
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != GIF_TRAILER:
+            raise ValueError('{} does not end with a GIF trailer'.format(path))
+        f.seek(-1, os.SEEK_END)
+        f.write(frame + GIF_TRAILER)
+
+
+def render(images, path, nrow=8, scale=1, caption=None, gif_path=None):
+    # Writes a grid of uint8 images to a PNG at native resolution, each pixel
+    # repeated scale times, with an optional caption above it. With gif_path
+    # the grid is also appended to that animation, without path no PNG.
+    grid = make_grid(images, nrow)
+    if scale > 1:
+        grid = grid.repeat(scale, axis=0).repeat(scale, axis=1)
+    image = Image.fromarray(grid[:, :, 0] if grid.shape[2] == 1 else grid)
+    if caption is not None:
+        captioned = Image.new(image.mode, (image.width, image.height + CAPTION_HEIGHT), 'white')
+        captioned.paste(image, (0, CAPTION_HEIGHT))
+        ImageDraw.Draw(captioned).text((2, 2), caption, fill='black')
+        image = captioned
+    if gif_path is not None:
+        append_gif(image, gif_path)
+    if path is None:
+        return
+    if not os.path.splitext(path)[1]:
+        # Same file names as plt.savefig
+        path = '{}.png'.format(path)
+    image.save(path)
+
+
+class Renderer(object):
+    # Renders sample grids with render() in a worker process: the trainer only
+    # converts the images to uint8 and copies them to the host. With
+    # max_in_flight grids not written yet, submit() waits for the oldest.
+    # The frames of render_async() are written as PNGs with png and appended
+    # to the animation set by start_gif().
+    # The worker is forked, so the Renderer must be created before any thread
+    # starts and before CUDA is initialized. Without background, or where
+    # fork is not available, grids are written in submit().
+    def __init__(self, nrow=8, scale=1, png=True, background=True, max_in_flight=4):
+        self.nrow = nrow
+        self.scale = scale
+        self.png = png
+        self.gif_path = None
+        self.max_in_flight = max_in_flight
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.pool = None
+        if background and 'fork' in multiprocessing.get_all_start_methods():
+            self.pool = multiprocessing.get_context('fork').Pool(1)
+
+    def start_gif(self, gif_path, resume=False):
+        # Frames are appended to gif_path, started over unless resume is set
+        if not resume and os.path.isfile(gif_path):
+            os.remove(gif_path)
+        self.gif_path = gif_path
+
+    def submit(self, images, path, caption=None, gif_path=None):
+        # Renders uint8 images already on the host, from any thread
+        args = (np.asarray(images), path, self.nrow, self.scale, caption, gif_path)
+        if self.pool is None:
+            render(*args)
+            return
+        with self.lock:
+            while len(self.pending) >= self.max_in_flight:
+                self.pending.popleft().get()
+            # One worker, so the frames reach the animation in order
+            self.pending.append(self.pool.apply_async(render, args))
+
+    def render_async(self, images, path, caption=None):
+        # Frame of the generated images, still on their device
+        images = to_uint8(images).cpu().numpy()
+        self.submit(images, path if self.png else None, caption, self.gif_path)
+
+    def close(self):
+        # Waits for the grids left, errors of the worker are raised here
+        while self.pending:
+            self.pending.popleft().get()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
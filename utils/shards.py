@@ -0,0 +1,164 @@
+import io
+import os
+import json
+import math
+import random
+import tarfile
+import argparse
+
+import torch
+import torchvision
+
+from utils.fast_decode import open_image
+
+
+def shard_dir(image_folder):
+    return '{}_shards/'.format(os.path.normpath(image_folder))
+
+
+def write_shards(image_folder, shard_size=10000, min_shards=1):
+    out_dir = shard_dir(image_folder)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    # ImageFolder only scans the folder, the files are copied as they are
+    folder = torchvision.datasets.ImageFolder(root=image_folder)
+    # At most shard_size images per shard, and a multiple of min_shards
+    # shards of even sizes, so that every reader gets the same number of them
+    n_samples = len(folder.samples)
+    n_shards = math.ceil(max(1, math.ceil(n_samples / shard_size)) / min_shards) * min_shards
+    n_shards = max(1, min(n_shards, n_samples))
+    print('Packing {} images from {} into {} shards'.format(n_samples, image_folder, n_shards))
+    shards = []
+    for s in range(n_shards):
+        start = s * n_samples // n_shards
+        samples = folder.samples[start:(s + 1) * n_samples // n_shards]
+        name = 'shard_{:05d}.tar'.format(len(shards))
+        tmp_path = '{}{}.tmp'.format(out_dir, name)
+        with tarfile.open(tmp_path, 'w') as tar:
+            for i, (path, target) in enumerate(samples):
+                key = '{:08d}'.format(start + i)
+                tar.add(path, arcname='{}{}'.format(key, os.path.splitext(path)[1].lower()))
+                # The class index is stored next to the image, as in webdataset
+                cls = str(target).encode()
+                info = tarfile.TarInfo('{}.cls'.format(key))
+                info.size = len(cls)
+                tar.addfile(info, io.BytesIO(cls))
+        os.replace(tmp_path, '{}{}'.format(out_dir, name))
+        shards.append({'name': name, 'count': len(samples)})
+        print('{}/{}'.format(start + len(samples), n_samples))
+
+    index = {
+        'root': image_folder,
+        'classes': folder.classes,
+        'num_samples': len(folder.samples),
+        'shards': shards,
+    }
+    with open('{}index.json'.format(out_dir), 'w') as f:
+        json.dump(index, f)
+    return out_dir
+
+
+def read_shard(path):
+    # Streams (image bytes, target) pairs, reading the tar file sequentially
+    image = None
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            data = tar.extractfile(member).read()
+            if member.name.endswith('.cls'):
+                yield image, int(data)
+                image = None
+            else:
+                image = data
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    # Each DataLoader worker reads its own shards, so workers beyond the
+    # number of shards of a process yield nothing. The dataset has no
+    # __len__: with several workers the DataLoader gets more short batches
+    # than a length would give, num_samples is the size of an epoch.
+    def __init__(self, shard_dir, image_size, shuffle_buffer=1000,
+                 fast_decode=False, rank=0, world_size=1):
+        super(ShardDataset, self).__init__()
+        with open('{}index.json'.format(shard_dir), 'r') as f:
+            index = json.load(f)
+        # In a distributed run each process reads its own fixed set of shards
+        shards = ['{}{}'.format(shard_dir, s['name']) for s in index['shards']]
+        self.shards = shards[rank::world_size]
+        self.num_samples = sum(s['count'] for s in index['shards'][rank::world_size])
+        self.image_size = image_size
+        self.shuffle_buffer = shuffle_buffer
+        self.fast_decode = fast_decode
+        # Passes over the dataset. Persistent workers keep their own copy,
+        # which advances the same way in all of them
+        self.epoch = 0
+
+    def decode(self, data):
+        img = open_image(io.BytesIO(data), self.image_size, self.fast_decode)
+        return torchvision.transforms.functional.pil_to_tensor(img)
+
+    def samples(self, shards):
+        for shard in shards:
+            for data, target in read_shard(shard):
+                yield self.decode(data), target
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            seed = torch.empty((), dtype=torch.int64).random_().item()
+            worker_id, num_workers = 0, 1
+        else:
+            # The DataLoader base seed is shared by all the workers, so with
+            # the epoch they all draw the same shard order and split it without
+            # overlap. The base seed is fixed for the lifetime of persistent
+            # workers, the epoch gives each pass its own order
+            seed = worker_info.seed - worker_info.id
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        epoch = self.epoch
+        self.epoch += 1
+        rng = random.Random('{}-{}'.format(seed, epoch))
+        shards = list(self.shards)
+        rng.shuffle(shards)
+        rng = random.Random('{}-{}-{}'.format(seed, epoch, worker_id))
+
+        buffer = []
+        for sample in self.samples(shards[worker_id::num_workers]):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+def num_shards(path):
+    if not os.path.isfile('{}index.json'.format(path)):
+        return 0
+    with open('{}index.json'.format(path), 'r') as f:
+        return len(json.load(f)['shards'])
+
+
+def load_shards(image_folder, image_size, fast_decode=False, rank=0, world_size=1, num_workers=0):
+    path = shard_dir(image_folder)
+    # Written by rank 0, again if there are fewer shards than readers (the
+    # workers of all the processes), the other processes wait for the index
+    min_shards = max(1, num_workers) * world_size
+    if rank == 0 and num_shards(path) < min_shards:
+        write_shards(image_folder, min_shards=min_shards)
+    if world_size > 1:
+        torch.distributed.barrier()
+    return ShardDataset(path, image_size, fast_decode=fast_decode,
+                        rank=rank, world_size=world_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_folder', type=str, required=True)
+    parser.add_argument('--shard_size', type=int, default=10000)
+    parser.add_argument('--min_shards', type=int, default=1,
+                        help='DataLoader workers times processes of the runs')
+    args = parser.parse_args()
+
+    write_shards(args.image_folder, args.shard_size, args.min_shards)
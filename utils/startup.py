@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import importlib
+
+# Time spent importing the modules wrapped by lazy_import
+lazy_import_times = {}
+
+
+class Lazy(object):
+    # Proxy that builds the wrapped object on first attribute access
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._object = None
+
+    def __getattr__(self, attr):
+        if self._object is None:
+            start = time.perf_counter()
+            self._object = self._factory()
+            lazy_import_times[self._name] = time.perf_counter() - start
+        return getattr(self._object, attr)
+
+
+def lazy_import(name):
+    return Lazy(name, lambda: importlib.import_module(name))
+
+
+def is_headless(headless='auto'):
+    if headless == 'auto':
+        return sys.platform.startswith('linux') and \
+            not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY')
+    return bool(headless)
+
+
+def set_headless():
+    # Must run before matplotlib is imported for the first time
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+class StartupTimer(object):
+    def __init__(self, start):
+        self.last = start
+        self.start = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        phases = ['{}: {:.2f}s'.format(phase, t) for phase, t in self.phases]
+        phases += ['import {}: {:.2f}s'.format(name, t)
+                   for name, t in lazy_import_times.items()]
+        print('Startup time {:.2f}s ({})'.format(
+            time.perf_counter() - self.start, ', '.join(phases)))
@@ -0,0 +1,158 @@
+import os
+import sys
+import csv
+import datetime
+import argparse
+import itertools
+import subprocess
+import concurrent.futures
+
+import yaml
+
+# Runs the training script of a model folder once per variant of its
+# config.yml, several runs at a time, e.g. from the repository root:
+#   python -m utils.sweep --script WGAN-GP/wgan_gp.py --sweep sweep.yml
+# where sweep.yml has a grid of values and/or a list of runs, for example
+#   grid:
+#     discriminator_filters: [64, 128]
+#     generator_filters: [64, 128]
+#   runs:
+#     - {batch_size: 64}
+#     - {batch_size: 128, epochs: 20}
+# Every run combines one point of the grid with one entry of runs.
+
+# Datasets read from image folders, shared by the runs through the uint8 cache
+FOLDER_DATASETS = ['CELEBA', 'POKEMON', 'CATS']
+
+
+def expand(sweep):
+    grid = sweep.get('grid') or {}
+    keys = list(grid)
+    points = [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+    runs = sweep.get('runs') or [{}]
+    return [dict(point, **run) for point in points for run in runs]
+
+
+def run_configs(base, variants, sweep_dir, threads):
+    # The decoded dataset is shared: image folders go through the memory
+    # mapped cache, built once by the first run and read by all of them
+    shared = {}
+    if base.get('data_format', 'folder') == 'folder' and base['dataset'] in FOLDER_DATASETS:
+        shared['data_format'] = 'cache'
+    configs = []
+    for i, variant in enumerate(variants):
+        config = dict(base, **shared)
+        config.update(variant)
+        if config.get('data_format') in ['cache', 'memory'] and 'num_workers' not in variant:
+            # Batches are slices of a tensor or of the cache, the prefetch
+            # thread loads them without workers
+            config['num_workers'] = 0
+        config.update({
+            'result_dir': '{}run_{:02d}/'.format(sweep_dir, i),
+            'threads_per_process': threads,
+            'tune_threads': False,
+            'headless': True,
+        })
+        configs.append(config)
+    return configs
+
+
+def download(dataset, folder):
+    # torchvision datasets are downloaded once, before the runs start
+    import torchvision
+    if dataset in ['MNIST', 'CIFAR10']:
+        dataset = getattr(torchvision.datasets, dataset)
+        dataset(folder, train=True, download=True)
+        dataset(folder, train=False, download=True)
+
+
+def train(script, config_path, log_path, threads):
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    with open(log_path, 'w') as log:
+        process = subprocess.run(
+            [sys.executable, os.path.basename(script), '--config', os.path.abspath(config_path)],
+            cwd=os.path.dirname(os.path.abspath(script)), env=env,
+            stdout=log, stderr=subprocess.STDOUT)
+    return process.returncode
+
+
+def summary_table(configs, variants, return_codes, model_dir):
+    keys = sorted({key for variant in variants for key in variant})
+    rows = []
+    for i, (config, variant, return_code) in enumerate(zip(configs, variants, return_codes)):
+        row = {'run': 'run_{:02d}'.format(i)}
+        row.update({key: variant.get(key, '') for key in keys})
+        row['status'] = 'ok' if return_code == 0 else 'failed ({})'.format(return_code)
+        summary_path = os.path.join(model_dir, config['result_dir'], 'summary.yml')
+        if os.path.isfile(summary_path):
+            with open(summary_path, 'r') as f:
+                row.update(yaml.load(f, yaml.Loader))
+        rows.append(row)
+    columns = []
+    for row in rows:
+        columns += [c for c in row if c not in columns]
+    return columns, rows
+
+
+def print_table(columns, rows):
+    def fmt(value):
+        return '{:.4g}'.format(value) if isinstance(value, float) else str(value)
+    widths = [max([len(c)] + [len(fmt(row.get(c, ''))) for row in rows]) for c in columns]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(fmt(row.get(c, '')).ljust(w) for c, w in zip(columns, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--script', type=str, required=True)
+    parser.add_argument('--sweep', type=str, required=True)
+    parser.add_argument('--base', type=str, default='None',
+                        help='base config, config.yml of the script folder by default')
+    parser.add_argument('--parallel', type=str, default='auto',
+                        help='runs at the same time, auto fills the cores')
+    parser.add_argument('--min_threads', type=int, default=4,
+                        help='fewest threads per run when parallel is auto')
+    args = parser.parse_args()
+
+    model_dir = os.path.dirname(os.path.abspath(args.script))
+    base_path = args.base if args.base != 'None' else os.path.join(model_dir, 'config.yml')
+    with open(base_path, 'r') as f:
+        base = yaml.load(f, yaml.Loader)
+    with open(args.sweep, 'r') as f:
+        variants = expand(yaml.load(f, yaml.Loader))
+
+    # The cores are split evenly between the runs that train at the same time
+    cores = os.cpu_count() or 1
+    if args.parallel == 'auto':
+        parallel = min(len(variants), max(1, cores // args.min_threads))
+    else:
+        parallel = min(len(variants), int(args.parallel))
+    threads = max(1, cores // parallel)
+
+    # Relative to the script folder, like the result directories of the scripts
+    sweep_dir = 'sweep_{}/'.format(datetime.datetime.now().strftime('%y-%m-%d_%H-%M'))
+    os.makedirs(os.path.join(model_dir, sweep_dir))
+    configs = run_configs(base, variants, sweep_dir, threads)
+    config_paths = []
+    for i, config in enumerate(configs):
+        config_paths.append(os.path.join(model_dir, sweep_dir, 'run_{:02d}.yml'.format(i)))
+        with open(config_paths[-1], 'w') as f:
+            yaml.dump(config, f, default_flow_style=False, sort_keys=False)
+    download(base['dataset'], os.path.join(model_dir, '..', 'data'))
+
+    print('{} runs, {} at a time with {} threads each, results in {}{}'.format(
+        len(configs), parallel, threads, model_dir, os.sep + sweep_dir))
+    with concurrent.futures.ThreadPoolExecutor(parallel) as pool:
+        # Each run is a separate training process, the pool only waits on them
+        futures = [pool.submit(train, args.script, path, path[:-len('.yml')] + '.log', threads)
+                   for path in config_paths]
+        for i, future in enumerate(futures):
+            print('run_{:02d} finished with code {}'.format(i, future.result()))
+
+    columns, rows = summary_table(configs, variants, [f.result() for f in futures], model_dir)
+    with open(os.path.join(model_dir, sweep_dir, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print_table(columns, rows)
@@ -0,0 +1,164 @@
+import os
+import time
+
+import torch
+
+from utils.distributed import local_world_size
+from utils.loader import with_options
+
+
+def available_cores():
+    # Cores of the machine for this process, shared with the other local
+    # processes of a distributed run
+    return max(1, (os.cpu_count() or 1) // local_world_size())
+
+
+def set_threads(threads='auto', interop_threads='auto'):
+    # Inter-op threads can only be set once, before any parallel work
+    if interop_threads != 'auto':
+        torch.set_num_interop_threads(interop_threads)
+    if threads == 'auto':
+        if local_world_size() == 1:
+            # torch default, one thread per core
+            return torch.get_num_threads()
+        # torchrun limits every process to one thread, share the cores of the
+        # machine between the local processes instead
+        threads = available_cores()
+    torch.set_num_threads(threads)
+    return threads
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def _time(step, n_steps, device):
+    # The first call warms up, it is not measured
+    step()
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    _sync(device)
+    return (time.perf_counter() - start) / n_steps
+
+
+def model_step_times(discriminator, generator, n_noise_features, batch_size, image_shape,
+                     device, channels_last=False, critic_loss=None, penalty_every=1, n_steps=3):
+    # Time of a critic step and of a generator step, forward and backward
+    # without the optimizer, with the current number of threads. The critic
+    # loss is mean(D(fake) - D(real)) unless critic_loss(real, fake,
+    # penalty_step) gives the loss of the training script: the critic time
+    # is then the mean over penalty_every steps, one of them with the penalty
+    real = torch.rand(batch_size, *image_shape, device=device) * 2 - 1
+    if channels_last:
+        real = real.contiguous(memory_format=torch.channels_last)
+    noise = torch.randn(batch_size, n_noise_features, device=device)
+    disc_params = [p for p in discriminator.parameters() if p.requires_grad]
+
+    def critic_step(penalty_step=False):
+        with torch.no_grad():
+            fake = generator(noise)
+        if critic_loss is None:
+            torch.mean(discriminator(fake) - discriminator(real)).backward()
+        else:
+            critic_loss(real, fake, penalty_step).backward()
+
+    def generator_step():
+        for p in disc_params:
+            p.requires_grad_(False)
+        try:
+            (- torch.mean(discriminator(generator(noise)))).backward()
+        finally:
+            for p in disc_params:
+                p.requires_grad_(True)
+
+    if critic_loss is None:
+        critic_time = _time(critic_step, n_steps, device)
+    else:
+        critic_time = _time(lambda: critic_step(True), n_steps, device)
+        if penalty_every > 1:
+            critic_time = (critic_time + (penalty_every - 1) * _time(critic_step, n_steps, device)) / penalty_every
+    return critic_time, _time(generator_step, n_steps, device)
+
+
+def loader_batch_time(loader, n_batches=3):
+    # Time to load one batch in this process, which is the work of a single
+    # DataLoader worker. None when the batches do not come from workers.
+    if not isinstance(loader, torch.utils.data.DataLoader):
+        return None
+    iterator = iter(with_options(loader, {'num_workers': 0}))
+    next(iterator)
+    start = time.perf_counter()
+    loaded = 0
+    for _ in range(n_batches):
+        if next(iterator, None) is None:
+            break
+        loaded += 1
+    return (time.perf_counter() - start) / max(1, loaded)
+
+
+def tune_threads(discriminator, generator, n_noise_features, batch_size, image_shape, device,
+                 loader=None, critic_steps_per_batch=1., generator_steps_per_batch=1.,
+                 channels_last=False, critic_loss=None, penalty_every=1, n_steps=3,
+                 verbose=True):
+    # Splits the cores between compute threads and DataLoader workers. The
+    # steps of the models are timed at several thread counts, loading with w
+    # workers is taken as w times faster than in this process, and the split
+    # with the shortest time per batch is kept: with workers, computing and
+    # loading overlap, without them they add up. The models are left as they
+    # were. critic_loss and penalty_every are those of model_step_times().
+    # Returns (threads, workers).
+    cores = available_cores()
+    batch_time = loader_batch_time(loader)
+    candidates = sorted({cores, max(1, cores * 3 // 4), max(1, cores // 2),
+                         max(1, cores // 4), max(1, cores - 1)}, reverse=True)
+    models = (discriminator, generator)
+    states = [{k: v.clone() for k, v in m.state_dict().items()} for m in models]
+    results = []
+    for threads in candidates:
+        torch.set_num_threads(threads)
+        critic_time, generator_time = model_step_times(
+            discriminator, generator, n_noise_features, batch_size, image_shape,
+            device, channels_last, critic_loss, penalty_every, n_steps)
+        compute_time = critic_steps_per_batch * critic_time + generator_steps_per_batch * generator_time
+        workers = 0 if batch_time is None else min(8, cores - threads)
+        if batch_time is None:
+            total = compute_time
+        elif workers == 0:
+            total = compute_time + batch_time
+        else:
+            total = max(compute_time, batch_time / workers)
+        results.append((total, threads, workers, compute_time))
+    # Training steps changed the BatchNorm running stats and the gradients
+    for m, state in zip(models, states):
+        m.load_state_dict(state)
+        m.zero_grad(set_to_none=True)
+
+    total, threads, workers, _ = min(results)
+    torch.set_num_threads(threads)
+    if verbose:
+        if batch_time is not None:
+            print('Thread tuning, batch loaded in {:.0f} ms by one worker'.format(batch_time * 1000))
+        for t, th, w, c in results:
+            print('Threads: {}\tWorkers: {}\tCompute: {:.0f} ms\tPer batch: {:.0f} ms{}'.format(
+                th, w, c * 1000, t * 1000, '\t<-' if th == threads else ''))
+    return threads, workers
+
+
+def record_config(config_path, values):
+    # Sets keys of a config.yml in place, the other lines are kept as they are
+    with open(config_path, 'r', newline='') as f:
+        text = f.read()
+    newline = '\r\n' if '\r\n' in text else '\n'
+    lines = text.splitlines()
+    for key, value in values.items():
+        line = '{}: {}'.format(key, value)
+        matches = [i for i, l in enumerate(lines) if l.split(':')[0].strip() == key]
+        if matches:
+            lines[matches[0]] = line
+        else:
+            lines.append(line)
+    with open(config_path, 'w', newline='') as f:
+        f.write(newline.join(lines))
@@ -0,0 +1,19 @@
+import torch
+
+
+class BatchTransform(object):
+    # Converts a uint8 NCHW batch to float in [-1, 1] and optionally flips
+    # half of the images horizontally, with one vectorized op per step
+    def __init__(self, hflip=False, channels_last=False):
+        self.hflip = hflip
+        self.channels_last = channels_last
+
+    def __call__(self, images):
+        # Same as ToTensor followed by Normalize((0.5, ...), (0.5, ...))
+        images = images.float().div_(127.5).sub_(1)
+        if self.hflip:
+            flip = torch.rand(images.shape[0], 1, 1, 1, device=images.device) < 0.5
+            images = torch.where(flip, images.flip(3), images)
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images